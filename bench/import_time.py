@@ -0,0 +1,64 @@
+#
+# Measure the time to import package/aws-scheduler.py, the init duration of a cold Lambda start, with python -X importtime.
+# Each scenario is imported in a fresh interpreter and the best of --runs is checked against --budget-ms.
+#
+# python bench/import_time.py [--budget-ms 50] [--runs 5] [--top 10] > bench_output.txt
+#
+import argparse, os, subprocess, sys
+
+package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package')
+module_name = 'aws-scheduler'
+
+scenarios = [
+    ('gmt', {}),
+    ('olson time zone', {'TIME': 'Europe/London'}),
+    ('ec2 only', {'RDS_SCHEDULE': 'False'}),
+]
+
+#
+# Import the scheduler once in a fresh interpreter. Returns its cumulative import time in microseconds,
+# and (cumulative us, module) for each module it imports directly.
+#
+def import_time(env):
+    env = dict(os.environ, AWS_REGION=os.getenv('AWS_REGION', 'us-east-1'), PYTHONPATH=package_dir, **env)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', "__import__('%s')" % module_name],
+                             env=env, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr)
+
+    lines = []
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and 'self [us]' not in line:
+            self_us, cumulative_us, module = line[len('import time:'):].split('|')
+            lines.append((int(cumulative_us), module[1:]))
+
+    # Modules are listed after the modules they import, indented two spaces per level.
+    position = [module for cumulative_us, module in lines].index(module_name)
+    imports = []
+    for cumulative_us, module in reversed(lines[:position]):
+        if not module.startswith(' '):
+            break
+        if not module.startswith('   '):
+            imports.append((cumulative_us, module.strip()))
+    return lines[position][0], imports
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time of the scheduler against a budget.')
+    parser.add_argument('--budget-ms', type=float, default=50)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    over_budget = False
+    for name, env in scenarios:
+        total_us, imports = min(import_time(env) for run in range(args.runs))
+        total_ms = total_us / 1000.0
+        over_budget = over_budget or total_ms > args.budget_ms
+        print("%s: %.1f ms (budget %.1f ms) %s" % (name, total_ms, args.budget_ms, 'ok' if total_ms <= args.budget_ms else 'OVER BUDGET'))
+        for cumulative_us, module in sorted(imports, reverse=True)[:args.top]:
+            print("  %8.1f ms  %s" % (cumulative_us / 1000.0, module))
+
+    return 1 if over_budget else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
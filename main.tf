@@ -39,6 +39,7 @@ data "aws_iam_policy_document" "ec2-access-scheduler" {
   statement {
     actions = [
       "ec2:DescribeInstances",
+      "ec2:DescribeTags",
       "ec2:StopInstances",
       "ec2:StartInstances",
       "ec2:CreateTags",
@@ -48,6 +49,11 @@ data "aws_iam_policy_document" "ec2-access-scheduler" {
       "rds:StopDBInstance",
       "rds:ListTagsForResource",
       "rds:AddTagsToResource",
+      "sts:AssumeRole",
+      "lambda:InvokeFunction",
+      "tag:GetResources",
+      "events:DescribeRule",
+      "events:PutRule",
     ]
     resources = [
       "*",
@@ -122,13 +128,25 @@ resource "aws_lambda_function" "scheduler_lambda" {
   }
   environment {
     variables = {
-      TAG                = var.tag
-      SCHEDULE_TAG_FORCE = var.schedule_tag_force
-      EXCLUDE            = var.exclude
-      DEFAULT            = var.default
-      TIME               = var.time
-      RDS_SCHEDULE       = var.rds_schedule
-      EC2_SCHEDULE       = var.ec2_schedule
+      TAG                 = var.tag
+      SCHEDULE_TAG_FORCE  = var.schedule_tag_force
+      EXCLUDE             = var.exclude
+      DEFAULT             = var.default
+      TIME                = var.time
+      TIMEZONE_TAG        = var.timezone_tag
+      RDS_SCHEDULE        = var.rds_schedule
+      EC2_SCHEDULE        = var.ec2_schedule
+      RDS_WORKERS         = var.rds_workers
+      REGIONS             = var.regions
+      ROLE_ARNS           = var.role_arns
+      ACCOUNT_WORKERS     = var.account_workers
+      SHARD_SIZE          = var.shard_size
+      DISCOVERY           = var.discovery
+      EARLY_EXIT          = var.early_exit
+      RECONCILE           = var.reconcile
+      ADAPTIVE_WAKEUP     = var.adaptive_wakeup
+      RULE_NAME           = "${var.resource_name_prefix}check-scheduler-event"
+      SCHEDULE_EXPRESSION = var.schedule_expression
     }
   }
 }
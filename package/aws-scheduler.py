@@ -1,390 +1,1334 @@
-import boto3
-
-import sys, os, json, logging, datetime, time, pytz
-
-logger = logging.getLogger()
-logger.setLevel(logging.INFO)
-
-aws_region = None
-
-create_schedule_tag_force = os.getenv('SCHEDULE_TAG_FORCE', 'False')
-create_schedule_tag_force = create_schedule_tag_force.capitalize()
-logger.info("create_schedule_tag_force is %s." % create_schedule_tag_force)
-
-rds_schedule = os.getenv('RDS_SCHEDULE', 'True')
-rds_schedule = rds_schedule.capitalize()
-logger.info("rds_schedule is %s." % rds_schedule)
-
-ec2_schedule = os.getenv('EC2_SCHEDULE', 'True')
-ec2_schedule = ec2_schedule.capitalize()
-logger.info("ec2_schedule is %s." % ec2_schedule)
-debugmode = False
-
-def init():
-    # Setup AWS connection
-    aws_region     = os.getenv('AWS_REGION', 'us-east-1')
-
-    global ec2
-    logger.info("-----> Connecting to region \"%s\"", aws_region)
-    ec2 = boto3.resource('ec2', region_name=aws_region)
-    logger.info("-----> Connected to region \"%s\"", aws_region)
-
-def debugout(module, data):
-    if debugmode:
-        logger.info("DEBUG %s : %s" % (module, data))
-
-#
-# Add default 'schedule' tag to instance.
-# (Only if instance.id not excluded and create_schedule_tag_force variable is True.
-#
-def create_schedule_tag(instance):
-    exclude_list = os.environ.get('EXCLUDE').split(',')
-
-    autoscaling = False
-    for tag in instance.tags:
-        if 'aws:autoscaling:groupName' in tag['Key']:
-           autoscaling = True
-
-    if (create_schedule_tag_force == 'True') and (instance.id not in exclude_list) and (not autoscaling):
-        try:
-            schedule_tag =  os.getenv('TAG', 'schedule')
-            tag_value =  os.getenv('DEFAULT', '{"mon": {"start": [7], "stop": [19]},"tue": {"start": [7], "stop": [19]},"wed": {"start": [9, 22], "stop": [19]},"thu": {"start": [7], "stop": [2,19]}, "fri": {"start": [7], "stop": [19]}, "sat": {"start": [22]}, "sun": {"stop": [7]}}')
-            logger.info("About to create %s tag on EC2 instance %s with value: %s" % (schedule_tag,instance.id,tag_value))
-            tags = [{
-                "Key" : schedule_tag,
-                "Value" : tag_value
-            }]
-            instance.create_tags(Tags=tags)
-        except Exception as e:
-            logger.error("Error adding Tag to EC2 instance: %s" % e)
-    else:
-        if (autoscaling):
-            logger.info("Ignoring EC2 instance %s. It is part of an auto scaling group" % instance.id)
-        else:
-            logger.info("No 'schedule' tag found on EC2 instance %s. Use create_schedule_tag_force option to create the tag automagically" % instance.id)
-
-# state = start | stop
-def checkdate(data, state, day, hh):
-    debugout('checkdate', "DEBUG checkdate state (%s) day (%s) hh (%s) data (%s)" % (state, day, hh, data))
-
-    try:
-        schedule = {}
-        if data == '':
-            debugout('checkdate', "data is empty")
-            return False
-        elif len(data) > 1 and data[0] == '{':
-            # JSON-Format
-            debugout('checkdate', 'JSON format found. (%s)' % data)
-            schedule = json.loads(data)
-        else:
-            # RDS-Format
-            try:
-
-                debugout('checkdate', "RDS format found")
-                # remove ' ' at atart and end, replace multiple ' ' with ' '
-                t=dict(x.split('=') for x in ' '.join(data.split()).split(' '))
-                for d in t.keys():
-                    dday, datastate=d.split('_')
-                    val=[int(i) for i in t[d].split('/')]
-                    debugout('checkdate', "RDS data: dday (%s) datastate (%s) val (%s)" %(dday, datastate, val))
-                    dstate={}
-                    dstate[datastate]=val
-                    if dday in schedule:
-                        schedule[dday].update(dstate)
-                    else:
-                        schedule[dday]=dstate
-
-            except Exception as e:
-                logger.error("Error checkdate : %s" % (e))
-
-        if debugout:
-            for d in schedule.keys():
-                for s in schedule[d].keys():
-                    debugout('checkdate', 'keys: day (%s) state (%s)' % (d, s))
-
-    except:
-        logger.error("Error checkdate invalid data : %s : %s" % (data, e))
-
-    try:
-        schedule_data = []
-
-        if day in schedule.keys() and state in schedule[day]:
-            if type(schedule[day][state]) is list:
-                schedule_data = schedule[day][state]
-            else:
-                schedule_data = [schedule[day][state]]
-            debugout('checkdate', 'day schedule_data %s' % ', '.join(str(s) for s in schedule_data))
-
-        if 'daily' in schedule.keys() and state in schedule['daily']:
-            if type(schedule['daily'][state]) is list:
-                schedule_data.extend(schedule['daily'][state])
-            else:
-                schedule_data.extend([int(schedule['daily'][state])])
-            debugout('checkdate', 'daily schedule_data %s' % ', '.join(str(s) for s in schedule_data))
-
-        workdays = ['mon', 'tue', 'wed', 'thu', 'fri']
-        if day in workdays and 'workday' in schedule.keys() and state in schedule['workday']:
-            debugout('checkdate', 'workday found')
-            if type(schedule['workday'][state]) is list:
-                schedule_data.extend(schedule['workday'][state])
-            else:
-                schedule_data.extend([schedule['workday'][state]])
-            debugout('checkdate', 'workday schedule_data %s' % ', '.join(str(s) for s in schedule_data))
-
-        debugout('checkdate', 'len %i schedule_data %s' % (len(schedule_data), ','.join(str(s) for s in schedule_data)))
-
-        if int(hh) in schedule_data:
-            logger.info("checkdate %s time matches hh (%i)" % (state, int(hh)))
-            return True
-
-        return False
-    except Exception as e:
-        logger.error("Error checkdate %s time : %s" % (state, e))
-
-#
-# Loop EC2 instances and check if a 'schedule' tag has been set. Next, evaluate value and start/stop instance if needed.
-#
-def check():
-    # Get all reservations.
-    instances = ec2.instances.filter(
-    Filters=[{'Name': 'instance-state-name', 'Values': ['pending','running','stopping','stopped']}])
-
-    # Get current day + hour (using gmt by default if time parameter not set to local)
-    time_zone =  os.getenv('TIME', 'gmt')
-    if time_zone == 'local':
-        hh  = int(time.strftime("%H", time.localtime()))
-        day = time.strftime("%a", time.localtime()).lower()
-        logger.info("-----> Checking for EC2 instances to start or stop for 'day' " + day + " 'local time' hour " + str(hh))
-    elif time_zone == 'gmt':
-        hh  = int(time.strftime("%H", time.gmtime()))
-        day = time.strftime("%a", time.gmtime()).lower()
-        logger.info("-----> Checking for EC2 instances to start or stop for 'day' " + day + " 'gmt' hour " + str(hh))
-    else:
-        if time_zone in pytz.all_timezones:
-            d = datetime.datetime.now()
-            d = pytz.utc.localize(d)
-            req_timezone = pytz.timezone(time_zone)
-            d_req_timezone = d.astimezone(req_timezone)
-            hh = int(d_req_timezone.strftime("%H"))
-            day = d_req_timezone.strftime("%a").lower()
-            logger.info("-----> Checking for EC2 instances to start or stop for 'day' " + day + " '" + time_zone + "' hour " + str(hh))
-        else:
-            logger.error('Invalid time timezone string value \"%s\", please check!' %(time_zone))
-            raise ValueError('Invalid time timezone string value')
-
-    started = []
-    stopped = []
-
-    schedule_tag = os.getenv('TAG', 'schedule')
-    logger.info("-----> schedule tag is called \"%s\"", schedule_tag)
-    if not instances:
-        logger.error('Unable to find any EC2 Instances, please check configuration')
-
-    for instance in instances:
-        logger.info("-----> Evaluating EC2 instance \"%s\" state %s" % (instance.id, instance.state["Name"]))
-
-        try:
-            data = "{}"
-            for tag in instance.tags:
-                if schedule_tag in tag['Key']:
-                    data = tag['Value']
-                    break
-            else:
-                # 'schedule' tag not found, create if appropriate.
-                create_schedule_tag(instance)
-
-            try:
-                if checkdate(data, 'start', day, hh) and instance.state["Name"] != 'running':
-
-                    logger.info("Starting EC2 instance \"%s\"." %(instance.id))
-                    started.append(instance.id)
-                    ec2.instances.filter(InstanceIds=[instance.id]).start()
-            except Exception as e:
-                logger.error("Error checking start time : %s" % e)
-                pass
-
-            try:
-                if checkdate(data, 'stop', day, hh) and instance.state["Name"] == 'running':
-
-                    logger.info("Stopping EC2 instance \"%s\"." %(instance.id))
-                    stopped.append(instance.id)
-                    ec2.instances.filter(InstanceIds=[instance.id]).stop()
-            except Exception as e:
-                logger.error("Error checking stop time : %s" % e)
-
-
-        except ValueError as e:
-            # invalid JSON
-            logger.error('Invalid value for tag \"schedule\" on EC2 instance \"%s\", please check!' %(instance.id))
-
-def rds_init():
-    # Setup AWS connection
-    aws_region     = os.getenv('AWS_REGION', 'us-east-1')
-
-    logger.info("-----> Connecting rds to region \"%s\"", aws_region)
-    global rds
-    rds = boto3.client('rds', region_name=aws_region)
-    logger.info("-----> Connected rds to region \"%s\"", aws_region)
-
-#
-# Add default 'schedule' tag to instance.
-# (Only if instance.id not excluded and create_schedule_tag_force variable is True.
-#
-def rds_create_schedule_tag(instance, object_type):
-    exclude_list = os.environ.get('EXCLUDE').split(',')
-
-    if (create_schedule_tag_force == 'True') and (instance['DB'+object_type+'Identifier'] not in exclude_list):
-        try:
-            schedule_tag =  os.getenv('TAG', 'schedule')
-            tag_default =  os.getenv('DEFAULT', '{"mon": {"start": 7, "stop": 20},"tue": {"start": 7, "stop": 20},"wed": {"start": 7, "stop": 20},"thu": {"start": 7, "stop": 20}, "fri": {"start": 7, "stop": 20}}')
-            logger.info("json tag_value: %s" % tag_default)
-
-            if len(tag_default) > 1 and tag_default[0] == '{':
-                tag = json.loads(tag_default)
-                tag_dict = flattenjson(tag, "_")
-                tag_value= dict_to_string(tag_dict)
-            else:
-                # use default string without convert to JSON
-                tag_value=tag_default
-
-            logger.info("About to create %s tag on RDS instance %s with value: %s" % (schedule_tag,instance['DBInstanceIdentifier'],tag_value))
-            tags = [{
-                "Key" : schedule_tag,
-                "Value" : tag_value
-            }]
-            rds.add_tags_to_resource(ResourceName=instance['DB'+object_type+'Arn'],Tags=tags)
-        except Exception as e:
-            logger.error("Error adding Tag to RDS instance: %s" % e)
-    else:
-        logger.info("No 'schedule' tag found on RDS instance %s. Use create_schedule_tag_force option to create the tag automagically" % instance['DB'+object_type+'Identifier'])
-
-def flattenjson( b, delim ):
-    val = {}
-    for i in b.keys():
-        if isinstance( b[i], dict ):
-            get = flattenjson( b[i], delim )
-            for j in get.keys():
-                val[ i + delim + j ] = get[j]
-        else:
-            val[i] = b[i]
-
-    return val
-
-def dict_to_string( d ):
-    val = ""
-    for k, v in d.items():
-         if type(v) is list:
-             vs='/'.join(str(s) for s in v)
-         else:
-             vs=v
-         if len(val) == 0 :
-             val=k+"="+str(vs)
-         else:
-             val=val+" "+k+"="+str(vs)
-
-    return val
-
-
-#
-# Loop RDS instances and check if a 'schedule' tag has been set. Next, evaluate value and start/stop instance if needed.
-#
-def rds_check():
-    # Get all reservations.
-    instances = rds.describe_db_instances()
-    clusters = rds.describe_db_clusters()
-
-    # Get current day + hour (using gmt by default if time parameter not set to local)
-    time_zone = os.getenv('TIME', 'gmt')
-    if time_zone == 'local':
-        hh  = int(time.strftime("%H", time.localtime()))
-        day = time.strftime("%a", time.localtime()).lower()
-        logger.info("-----> Checking RDS instances to start or stop for 'day' " + day + " 'local time' hour " + str(hh))
-    elif time_zone == 'gmt':
-        hh  = int(time.strftime("%H", time.gmtime()))
-        day = time.strftime("%a", time.gmtime()).lower()
-        logger.info("-----> Checking RDS instances to start or stop for 'day' " + day + " 'gmt' hour " + str(hh))
-    else:
-        if time_zone in pytz.all_timezones:
-            d = datetime.datetime.now()
-            d = pytz.utc.localize(d)
-            req_timezone = pytz.timezone(time_zone)
-            d_req_timezone = d.astimezone(req_timezone)
-            hh = int(d_req_timezone.strftime("%H"))
-            day = d_req_timezone.strftime("%a").lower()
-            logger.info("-----> Checking RDS instances to start or stop for 'day' " + day + " '" + time_zone + "' hour " + str(hh))
-        else:
-            logger.error('Invalid time timezone string value \"%s\", please check!' %(time_zone))
-            raise ValueError('Invalid time timezone string value')
-
-    if not instances:
-        logger.error('Unable to find any RDS Instances, please check configuration')
-    hh = str(hh)
-    rds_loop(instances, hh, day, 'Instance')
-    rds_loop(clusters, hh, day, 'Cluster')
-
-
-#
-# Checks the schedule tags for instances or clusters, and stop/starts accordingly
-#
-def rds_loop(rds_objects, hh, day, object_type):
-    started = []
-    stopped = []
-
-    schedule_tag = os.getenv('TAG', 'schedule')
-    logger.info("-----> schedule tag is called \"%s\"", schedule_tag)
-    for instance in rds_objects['DB'+object_type+'s']:
-        if 'DBInstanceStatus' not in instance: instance['DBInstanceStatus'] = ''
-        if 'Status' not in instance: instance['Status'] = ''
-        # instance = json.loads(db_instance)
-        logger.info("-----> Evaluating RDS instance \"%s\" state: %s" % (instance['DB'+object_type+'Identifier'], instance['DBInstanceStatus']))
-        response = rds.list_tags_for_resource(ResourceName=instance['DB'+object_type+'Arn'])
-        taglist = response['TagList']
-        try:
-            data = ""
-            for tag in taglist:
-                if schedule_tag in tag['Key']:
-                    data = tag['Value']
-                    break
-            else:
-                rds_create_schedule_tag(instance, object_type)
-
-            try:
-                # Convert the start/stop hour into a list, in case of multiple values
-                if checkdate(data, 'start', day, hh) and (instance['DBInstanceStatus'] == 'stopped' or instance['Status'] == 'stopped'):
-
-                    logger.info("-----> Starting RDS instance \"%s\"." %(instance['DB'+object_type+'Identifier']))
-                    started.append(instance['DB'+object_type+'Identifier'])
-                    if object_type == 'Instance': rds.start_db_instance(DBInstanceIdentifier=instance['DB'+object_type+'Identifier'])
-                    if object_type == 'Cluster': rds.start_db_cluster(DBClusterIdentifier=instance['DB'+object_type+'Identifier'])
-
-                elif checkdate(data, 'stop', day, hh) and (instance['DBInstanceStatus'] == 'available' or instance['Status'] == 'available'):
-                    logger.info("-----> Stopping RDS instance \"%s\"." %(instance['DB'+object_type+'Identifier']))
-                    stopped.append(instance['DB'+object_type+'Identifier'])
-                    if object_type == 'Instance': rds.stop_db_instance(DBInstanceIdentifier=instance['DB'+object_type+'Identifier'])
-                    if object_type == 'Cluster': rds.stop_db_cluster(DBClusterIdentifier=instance['DB'+object_type+'Identifier'])
-            except Exception as e:
-                logger.info("ERROR rds_loop \"%s\" " % (e))
-                pass # catch exception if 'stop' is not in schedule.
-
-        except ValueError as e:
-            # invalid JSON
-            logger.error(e)
-            logger.error('Invalid value for tag \"schedule\" on RDS instance \"%s\", please check!' %(instance['DB'+object_type+'Identifier']))
-
-
-# Main function. Entrypoint for Lambda
-def handler(event, context):
-
-    if (ec2_schedule == 'True'):
-        init()
-        check()
-
-    if (rds_schedule == 'True'):
-        rds_init()
-        rds_check()
-
-# Manual invocation of the script (only used for testing)
-if __name__ == "__main__":
-    # Test data
-    test = {}
-    handler(test, None)
+import os, json, logging, datetime, time, collections, concurrent.futures, threading
+
+# boto3 and pytz are slow to import, so they are only imported by the code that uses them: boto3 when the
+# first AWS connection is made (a run skipped by early exit makes none), pytz when an Olson time zone is used.
+# AWS errors are recognised by their response rather than by botocore's ClientError for the same reason.
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+aws_region = os.getenv('AWS_REGION', 'us-east-1')
+
+# Comma separated list of regions to schedule, defaults to the region the Lambda runs in.
+regions = [r.strip() for r in os.getenv('REGIONS', '').split(',') if r.strip()] or [aws_region]
+logger.info("regions are %s." % ', '.join(regions))
+
+# Comma separated list of IAM role arns to assume, one per account to schedule. Empty for the Lambda's own account.
+default_role_arns = [r.strip() for r in os.getenv('ROLE_ARNS', '').split(',') if r.strip()]
+account_workers = int(os.getenv('ACCOUNT_WORKERS', '5'))
+
+# With a shard size the invocation coordinates: it splits the fleet into shards of that many
+# EC2 instances and invokes this function asynchronously once per shard. 0 disables sharding.
+shard_size = int(os.getenv('SHARD_SIZE', '0'))
+# The instance ids of a shard are sent in the asynchronous Invoke payload, which is limited to 256 KB.
+max_shard_size = 5000
+if shard_size > max_shard_size:
+    logger.warning("shard_size %i is over the maximum of %i, using %i." % (shard_size, max_shard_size, max_shard_size))
+    shard_size = max_shard_size
+
+# How resources are discovered: 'describe' lists every EC2 and RDS resource, 'tagging' queries the
+# Resource Groups Tagging API for resources with the schedule tag and only describes those with an action due.
+discovery = os.getenv('DISCOVERY', 'describe').lower()
+logger.info("discovery is %s." % discovery)
+
+# With early exit an invocation at an hour where no known schedule has a transition returns without listing
+# anything. The schedules are known from the last complete run, and refreshed at least every index_max_age hours.
+early_exit = os.getenv('EARLY_EXIT', 'False').capitalize()
+index_max_age = int(os.getenv('INDEX_MAX_AGE', '24'))
+
+# With reconcile each resource is brought to the state of the most recent start or stop of its schedule,
+# so a run that is late or missed is caught up by the next one. Otherwise only the hour of a start or stop acts.
+reconcile = os.getenv('RECONCILE', 'False').capitalize()
+
+# A run with less than this many seconds left hands the rest of its work to a continuation invocation.
+continuation_margin = int(os.getenv('CONTINUATION_MARGIN', '30'))
+
+create_schedule_tag_force = os.getenv('SCHEDULE_TAG_FORCE', 'False')
+create_schedule_tag_force = create_schedule_tag_force.capitalize()
+logger.info("create_schedule_tag_force is %s." % create_schedule_tag_force)
+if discovery == 'tagging' and create_schedule_tag_force == 'True':
+    logger.warning("Untagged resources are not discovered with 'tagging' discovery, so no default schedule tags are created.")
+
+rds_schedule = os.getenv('RDS_SCHEDULE', 'True')
+rds_schedule = rds_schedule.capitalize()
+logger.info("rds_schedule is %s." % rds_schedule)
+
+ec2_schedule = os.getenv('EC2_SCHEDULE', 'True')
+ec2_schedule = ec2_schedule.capitalize()
+logger.info("ec2_schedule is %s." % ec2_schedule)
+
+ec2_default_schedule = os.getenv('DEFAULT', '{"mon": {"start": [7], "stop": [19]},"tue": {"start": [7], "stop": [19]},"wed": {"start": [9, 22], "stop": [19]},"thu": {"start": [7], "stop": [2,19]}, "fri": {"start": [7], "stop": [19]}, "sat": {"start": [22]}, "sun": {"stop": [7]}}')
+rds_default_schedule = os.getenv('DEFAULT', '{"mon": {"start": 7, "stop": 20},"tue": {"start": 7, "stop": 20},"wed": {"start": 7, "stop": 20},"thu": {"start": 7, "stop": 20}, "fri": {"start": 7, "stop": 20}}')
+
+# TIME is 'gmt', 'local' or an Olson time zone name. The zone is looked up once and kept for warm invocations.
+time_zone = os.getenv('TIME', 'gmt')
+
+# A resource with this tag is scheduled in the Olson time zone of its value instead of TIME. Empty to disable.
+timezone_tag = os.getenv('TIMEZONE_TAG', '')
+logger.info("timezone_tag is \"%s\"." % timezone_tag)
+
+if time_zone not in ('gmt', 'local') or timezone_tag:
+    import pytz
+
+# Time zones are built straight from their zoneinfo file and cached by name. pytz.timezone() checks the name
+# against all_timezones_set first, which opens every zoneinfo file in the bundle. None for an unknown zone.
+time_zones = {}
+
+def load_timezone(zone):
+    if zone not in time_zones:
+        if zone.upper() == 'UTC':
+            time_zones[zone] = pytz.utc
+        else:
+            try:
+                with pytz.open_resource(zone) as fp:
+                    time_zones[zone] = pytz.build_tzinfo(zone, fp)
+            except (IOError, ValueError, AssertionError):
+                time_zones[zone] = None
+    return time_zones[zone]
+
+time_zone_info = None
+if time_zone not in ('gmt', 'local'):
+    time_zone_info = load_timezone(time_zone)
+    if time_zone_info is None:
+        logger.error('Invalid time timezone string value \"%s\", please check!' %(time_zone))
+
+rds_workers = int(os.getenv('RDS_WORKERS', '10'))
+logger.info("rds_workers is %i." % rds_workers)
+debugmode = False
+
+ec2_state_filter = {'Name': 'instance-state-name', 'Values': ['pending','running','stopping','stopped']}
+
+# Maximum number of instance ids sent in one StartInstances/StopInstances request, and in one 'instance-id' filter.
+ec2_batch_size = 100
+ec2_filter_size = 200
+# Error codes caused by some of the instances in a request, a batch failing with one of these is bisected.
+# Any other error, e.g. throttling or a missing permission, fails every request alike and fails the batch as a whole.
+ec2_instance_errors = ['IncorrectInstanceState', 'UnsupportedOperation', 'InvalidInstanceID']
+
+# Compiled schedules are cached by tag value for the life of the Lambda execution environment.
+schedule_cache_size = int(os.getenv('SCHEDULE_CACHE_SIZE', '256'))
+schedule_cache = collections.OrderedDict()
+schedule_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+schedule_cache_lock = threading.Lock()
+run_active_hours = {'start': 0, 'stop': 0}
+
+# boto3 clients are cached by (service, region, role) for warm invocations.
+aws_connections = {}
+aws_connections_lock = threading.Lock()
+max_pool_connections = {'rds': rds_workers}
+
+# Sessions of assumed roles, cached by role arn until role_renew_seconds before their credentials expire.
+# Each role has its own lock, so accounts assume their roles side by side but a role is only assumed once at a time.
+role_sessions = {}
+role_locks = collections.defaultdict(threading.Lock)
+role_locks_lock = threading.Lock()
+role_renew_seconds = 300
+
+#
+# Return a boto3 client, created once per execution environment
+# so warm invocations skip session setup, endpoint resolution and TLS handshakes.
+#
+def get_connection(service, region, role_arn=None):
+    import boto3
+    from botocore.config import Config
+    key = (service, region, role_arn)
+    session = get_session(role_arn) if role_arn else None
+    with aws_connections_lock:
+        # Clients of an assumed role are rebuilt once its credentials have been renewed.
+        if key not in aws_connections or aws_connections[key][0] is not session:
+            logger.info("-----> Creating %s client for region \"%s\"" % (service, region))
+            config = Config(max_pool_connections=max_pool_connections.get(service, 10))
+            aws_connections[key] = (session, (session or boto3).client(service, region_name=region, config=config))
+        return aws_connections[key][1]
+
+#
+# Return a boto3 session for an assumed role. The temporary credentials are cached
+# across warm invocations and renewed shortly before they expire.
+#
+def get_session(role_arn):
+    with role_locks_lock:
+        role_lock = role_locks[role_arn]
+    with role_lock:
+        if role_arn in role_sessions:
+            session, expiration = role_sessions[role_arn]
+            if expiration - datetime.timedelta(seconds=role_renew_seconds) > datetime.datetime.now(datetime.timezone.utc):
+                return session
+
+        logger.info("-----> Assuming role \"%s\"" % role_arn)
+        sts = get_connection('sts', aws_region)
+        credentials = sts.assume_role(RoleArn=role_arn, RoleSessionName='aws-scheduler')['Credentials']
+        import boto3
+        session = boto3.session.Session(
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken'])
+        role_sessions[role_arn] = (session, credentials['Expiration'])
+        return session
+
+def init(aws_region, role_arn=None):
+    # Setup AWS connection
+    logger.info("-----> Connecting to region \"%s\"", aws_region)
+    ec2 = get_connection('ec2', aws_region, role_arn)
+    logger.info("-----> Connected to region \"%s\"", aws_region)
+    return ec2
+
+def debugout(module, data):
+    if debugmode:
+        logger.info("DEBUG %s : %s" % (module, data))
+
+#
+# Add default 'schedule' tag to instance.
+# (Only if instance.id not excluded and create_schedule_tag_force variable is True.
+#
+def create_schedule_tag(ec2, instance):
+    exclude_list = os.environ.get('EXCLUDE').split(',')
+
+    autoscaling = False
+    for tag in instance.get('Tags', []):
+        if 'aws:autoscaling:groupName' in tag['Key']:
+           autoscaling = True
+
+    if (create_schedule_tag_force == 'True') and (instance['InstanceId'] not in exclude_list) and (not autoscaling):
+        try:
+            schedule_tag =  os.getenv('TAG', 'schedule')
+            tag_value =  ec2_default_schedule
+            logger.info("About to create %s tag on EC2 instance %s with value: %s" % (schedule_tag,instance['InstanceId'],tag_value))
+            tags = [{
+                "Key" : schedule_tag,
+                "Value" : tag_value
+            }]
+            ec2.create_tags(Resources=[instance['InstanceId']], Tags=tags)
+        except Exception as e:
+            logger.error("Error adding Tag to EC2 instance: %s" % e)
+    else:
+        if (autoscaling):
+            logger.info("Ignoring EC2 instance %s. It is part of an auto scaling group" % instance['InstanceId'])
+        else:
+            logger.info("No 'schedule' tag found on EC2 instance %s. Use create_schedule_tag_force option to create the tag automagically" % instance['InstanceId'])
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+WORKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri']
+
+#
+# A schedule tag value compiled into a start and a stop bitmask over the 7x24 hours of the week.
+# Bit (day index * 24 + hour) is set when the schedule asks for that state at that hour,
+# with 'daily' and 'workday' entries already merged into the individual days.
+#
+CompiledSchedule = collections.namedtuple('CompiledSchedule', ['start', 'stop'])
+
+EMPTY_SCHEDULE = CompiledSchedule(0, 0)
+
+def week_hour(day, hh):
+    return DAYS.index(day) * 24 + int(hh)
+
+#
+# Parse a schedule tag value (JSON or RDS format) into a dict of day -> state -> hours.
+#
+def parse_schedule(data):
+    schedule = {}
+    if data == '':
+        debugout('parse_schedule', "data is empty")
+    elif len(data) > 1 and data[0] == '{':
+        # JSON-Format
+        debugout('parse_schedule', 'JSON format found. (%s)' % data)
+        schedule = json.loads(data)
+    else:
+        # RDS-Format
+        try:
+            debugout('parse_schedule', "RDS format found")
+            # remove ' ' at atart and end, replace multiple ' ' with ' '
+            t=dict(x.split('=') for x in ' '.join(data.split()).split(' '))
+            for d in t.keys():
+                dday, datastate=d.split('_')
+                val=[int(i) for i in t[d].split('/')]
+                debugout('parse_schedule', "RDS data: dday (%s) datastate (%s) val (%s)" %(dday, datastate, val))
+                dstate={}
+                dstate[datastate]=val
+                if dday in schedule:
+                    schedule[dday].update(dstate)
+                else:
+                    schedule[dday]=dstate
+
+        except Exception as e:
+            logger.error("Error parse_schedule : %s" % (e))
+
+    return schedule
+
+def schedule_hours(value):
+    if type(value) is not list:
+        value = [value]
+    return [int(h) for h in value if 0 <= int(h) < 24]
+
+#
+# Compile a schedule tag value into a CompiledSchedule. Data that cannot be parsed compiles to an empty schedule,
+# an invalid day or state entry is logged and skipped so the rest of the schedule still applies.
+#
+def compile_schedule(data):
+    try:
+        schedule = parse_schedule(data)
+    except Exception as e:
+        logger.error("Error compile_schedule invalid data : %s : %s" % (data, e))
+        return EMPTY_SCHEDULE
+
+    masks = {'start': 0, 'stop': 0}
+    for d in schedule.keys():
+        if d == 'daily':
+            days = DAYS
+        elif d == 'workday':
+            days = WORKDAYS
+        elif d in DAYS:
+            days = [d]
+        else:
+            debugout('compile_schedule', 'ignoring unknown day (%s)' % d)
+            continue
+        for state in masks.keys():
+            try:
+                if state not in schedule[d]:
+                    continue
+                hours = schedule_hours(schedule[d][state])
+            except Exception as e:
+                logger.error("Error compile_schedule invalid data for day (%s) state (%s) : %s : %s" % (d, state, data, e))
+                continue
+            for hh in hours:
+                for day in days:
+                    masks[state] |= 1 << week_hour(day, hh)
+            debugout('compile_schedule', 'day (%s) state (%s) hours %s' % (d, state, schedule[d][state]))
+
+    return CompiledSchedule(masks['start'], masks['stop'])
+
+#
+# Return the compiled schedule for a tag value, compiling it only on a cache miss.
+#
+def get_schedule(data):
+    with schedule_cache_lock:
+        if data in schedule_cache:
+            schedule_cache_stats['hits'] += 1
+            schedule_cache.move_to_end(data)
+            compiled = schedule_cache[data]
+        else:
+            schedule_cache_stats['misses'] += 1
+            compiled = compile_schedule(data)
+            schedule_cache[data] = compiled
+            while len(schedule_cache) > schedule_cache_size:
+                schedule_cache.popitem(last=False)
+                schedule_cache_stats['evictions'] += 1
+
+        # Union of the schedules used by the current run, for the active hours index.
+        run_active_hours['start'] |= compiled.start
+        run_active_hours['stop'] |= compiled.stop
+        return compiled
+
+def log_schedule_cache_stats():
+    logger.info("-----> Schedule cache: %i entries, %i hits, %i misses, %i evictions" % (len(schedule_cache), schedule_cache_stats['hits'], schedule_cache_stats['misses'], schedule_cache_stats['evictions']))
+
+# state = start | stop
+def is_due(compiled, state, wh):
+    return (getattr(compiled, state) >> wh) & 1 == 1
+
+# The state of the most recent start or stop at or before wh, going back up to a week. An hour with both is skipped.
+def last_transition(compiled, wh):
+    for back in range(168):
+        h = (wh - back) % 168
+        start = (compiled.start >> h) & 1
+        stop = (compiled.stop >> h) & 1
+        if start != stop:
+            return 'start' if start else 'stop'
+    return None
+
+# The states a resource with this schedule is brought to at week hour wh.
+def due_states(compiled, wh):
+    if reconcile == 'True':
+        state = last_transition(compiled, wh)
+        return [state] if state else []
+    return [state for state in ('start', 'stop') if is_due(compiled, state, wh)]
+
+#
+# Evaluate each distinct schedule tag value once for each local week hour it is used at.
+# buckets maps (tag value, week hour) -> resources; yields (tag value, state, resources) for every due state.
+#
+def evaluate_buckets(buckets):
+    for (data, wh), members in buckets.items():
+        schedule = get_schedule(data)
+        for state in due_states(schedule, wh):
+            debugout('evaluate_buckets', '%s due for %i resources with schedule (%s)' % (state, len(members), data))
+            yield data, state, members
+
+#
+# UTC offsets of a time zone in minutes for every UTC hour of the current and the next week (starting monday 00:00 UTC),
+# so converting a time to a local day and hour is a table lookup. Tables are cached by zone until the next week is over.
+# Some zones change their offset during a UTC hour (e.g. Australia/Adelaide at 16:30 UTC), for those hours the table
+# also keeps the second of the hour the change happens at and the new offset.
+#
+zone_tables = {}
+zone_tables_lock = threading.Lock()
+WEEK_SECONDS = 7 * 24 * 3600
+EPOCH_MONDAY = 4 * 24 * 3600
+
+def zone_table(tzinfo, run_time):
+    week_start = run_time - (run_time - EPOCH_MONDAY) % WEEK_SECONDS
+    with zone_tables_lock:
+        table = zone_tables.get(tzinfo.zone)
+        if table is None or not table[0] <= run_time < table[0] + 2 * WEEK_SECONDS:
+            logger.info("-----> Building UTC offset table for time zone \"%s\"" % tzinfo.zone)
+            offsets = [offset_at(tzinfo, week_start + hour * 3600) for hour in range(2 * 168 + 1)]
+            changes = {}
+            for hour in range(2 * 168):
+                if offsets[hour] != offsets[hour + 1]:
+                    # Offsets change on a quarter hour at the latest.
+                    for second in (900, 1800, 2700):
+                        if offset_at(tzinfo, week_start + hour * 3600 + second) == offsets[hour + 1]:
+                            changes[hour] = (second, offsets[hour + 1])
+                            break
+            table = (week_start, offsets, changes)
+            zone_tables[tzinfo.zone] = table
+        return table
+
+def offset_at(tzinfo, run_time):
+    d = pytz.utc.localize(datetime.datetime.utcfromtimestamp(run_time))
+    return int(d.astimezone(tzinfo).utcoffset().total_seconds()) // 60
+
+# UTC offset in minutes of tzinfo at run_time.
+def zone_offset(tzinfo, run_time):
+    week_start, offsets, changes = zone_table(tzinfo, run_time)
+    hour = int((run_time - week_start) // 3600)
+    if hour in changes and run_time - week_start - hour * 3600 >= changes[hour][0]:
+        return changes[hour][1]
+    return offsets[hour]
+
+# Local day and hour of run_time in tzinfo.
+def zone_day_hour(tzinfo, run_time):
+    local_time = int(run_time) + zone_offset(tzinfo, run_time) * 60 - EPOCH_MONDAY
+    return DAYS[local_time // 86400 % 7], local_time % 86400 // 3600
+
+#
+# Get day + hour of run_time (using gmt by default if time parameter not set to local).
+# Returns (day, hour, label of the time zone for logging).
+#
+def local_day_hour(run_time):
+    if time_zone == 'local':
+        hh  = int(time.strftime("%H", time.localtime(run_time)))
+        day = time.strftime("%a", time.localtime(run_time)).lower()
+        return day, hh, "'local time'"
+    elif time_zone == 'gmt':
+        hh  = int(time.strftime("%H", time.gmtime(run_time)))
+        day = time.strftime("%a", time.gmtime(run_time)).lower()
+        return day, hh, "'gmt'"
+    else:
+        if time_zone_info is not None:
+            day, hh = zone_day_hour(time_zone_info, run_time)
+            return day, hh, "'" + time_zone + "'"
+        else:
+            logger.error('Invalid time timezone string value \"%s\", please check!' %(time_zone))
+            raise ValueError('Invalid time timezone string value')
+
+#
+# The clock of a run: the instant it evaluates with its local day, hour and week hour. It is resolved once
+# per invocation and passed to every account, region and phase, so they all evaluate the same hour.
+#
+Clock = collections.namedtuple('Clock', ['instant', 'day', 'hour', 'week_hour', 'label'])
+
+# Set to a function returning a timestamp to override the current time, e.g. to simulate runs.
+clock_time = None
+
+def get_clock(run_time=None):
+    if run_time is None:
+        run_time = clock_time() if clock_time is not None else time.time()
+    day, hh, time_label = local_day_hour(run_time)
+    return Clock(run_time, day, hh, week_hour(day, hh), time_label)
+
+#
+# Week hour of the clock for a resource: in the time zone of its timezone_tag, or of the run without one.
+# The week hours of the current clock are cached by zone, so each distinct zone is computed once per run.
+#
+zone_week_hours = {'instant': None, 'hours': {}}
+zone_week_hours_lock = threading.Lock()
+
+def resource_week_hour(tags, clock):
+    if not timezone_tag:
+        return clock.week_hour
+    zone = next((tag['Value'] for tag in tags if tag['Key'] == timezone_tag), None)
+    if zone is None:
+        return clock.week_hour
+    with zone_week_hours_lock:
+        if zone_week_hours['instant'] != clock.instant:
+            zone_week_hours.update({'instant': clock.instant, 'hours': {}})
+        hours = zone_week_hours['hours']
+        if zone not in hours:
+            tzinfo = load_timezone(zone)
+            if tzinfo is not None:
+                day, hh = zone_day_hour(tzinfo, clock.instant)
+                hours[zone] = week_hour(day, hh)
+            else:
+                logger.error('Invalid time zone \"%s\" in tag \"%s\", using %s' % (zone, timezone_tag, clock.label))
+                hours[zone] = clock.week_hour
+        return hours[zone]
+
+# Week hours at which a tag-only pass looks for a due start or stop: with timezone_tag, any zone's current hour (UTC-12 to UTC+14).
+def candidate_hours(clock):
+    if not timezone_tag:
+        return [clock.week_hour]
+    utc = time.gmtime(clock.instant)
+    utc_hour = utc.tm_wday * 24 + utc.tm_hour
+    return [(utc_hour + offset) % 168 for offset in range(-12, 15)]
+
+# Tag keys containing the schedule tag name are schedule tags, except the time zone tag (e.g. 'schedule_tz').
+def is_schedule_tag(key, schedule_tag):
+    return schedule_tag in key and key != timezone_tag
+
+#
+# Loop EC2 instances and check if a 'schedule' tag has been set. Next, evaluate value and start/stop instance if needed.
+#
+def check(ec2, instance_ids=None, context=None, cursor=None, clock=None, tagging=None):
+    clock = clock or get_clock()
+    logger.info("-----> Checking for EC2 instances to start or stop for 'day' " + clock.day + " " + clock.label + " hour " + str(clock.hour))
+
+    schedule_tag = os.getenv('TAG', 'schedule')
+    logger.info("-----> schedule tag is called \"%s\"", schedule_tag)
+
+    result = {'started': [], 'stopped': [], 'transitions': [], 'failed': []}
+    found = 0
+    # Unless untagged instances need a default tag, a cheap tag-only pass finds the instances
+    # with an action due and only those are described.
+    full_describe = instance_ids is not None or (tagging is None and create_schedule_tag_force == 'True')
+    if full_describe:
+        pages = ec2_pages(ec2, instance_ids, cursor, context)
+    elif tagging is not None:
+        pages = ec2_due_pages(ec2, ec2_tagging_pages(tagging, cursor, context), candidate_hours(clock))
+    else:
+        pages = ec2_due_pages(ec2, ec2_tag_pages(ec2, cursor, context), candidate_hours(clock))
+    for page_cursor, page in pages:
+        if page is None:
+            logger.info("-----> Running out of time, EC2 continues at %s" % page_cursor)
+            result['cursor'] = page_cursor
+            break
+        found += len(page)
+        to_start, to_stop = ec2_evaluate(ec2, page, clock, schedule_tag)
+        page_result = ec2_act(ec2, to_start, to_stop)
+        for key in page_result.keys():
+            result[key].extend(page_result[key])
+
+    if found == 0 and not cursor and full_describe:
+        logger.error('Unable to find any EC2 Instances, please check configuration')
+
+    return result
+
+#
+# Select the EC2 instances of one describe page that need to be started or stopped.
+#
+def ec2_evaluate(ec2, instances, clock, schedule_tag):
+    buckets = collections.OrderedDict()
+    for instance in instances:
+        logger.info("-----> Evaluating EC2 instance \"%s\" state %s" % (instance['InstanceId'], instance['State']['Name']))
+
+        data = "{}"
+        for tag in instance.get('Tags', []):
+            if is_schedule_tag(tag['Key'], schedule_tag):
+                data = tag['Value']
+                break
+        else:
+            # 'schedule' tag not found, create if appropriate.
+            create_schedule_tag(ec2, instance)
+
+        wh = resource_week_hour(instance.get('Tags', []), clock)
+        buckets.setdefault((data, wh), []).append(instance)
+
+    # Only act on settled states, so an instance evaluated again by a continuation is not actioned twice.
+    to_start = []
+    to_stop = []
+    for data, state, members in evaluate_buckets(buckets):
+        if state == 'start':
+            to_start.extend(instance['InstanceId'] for instance in members if instance['State']['Name'] == 'stopped')
+        else:
+            to_stop.extend(instance['InstanceId'] for instance in members if instance['State']['Name'] == 'running')
+
+    return to_start, to_stop
+
+#
+# Yield (cursor, instances) for each describe page of the EC2 instances check() evaluates, restricted
+# to instance_ids when given. The cursor is where a continuation resumes: the page's NextToken, or the
+# position in instance_ids. Ids are matched with an 'instance-id' filter so ids terminated since
+# sharding do not fail the request.
+# With a context the pages after the first are only fetched while there is time left. Once the Lambda
+# runs low on time (cursor, None) is yielded instead, so a continuation resumes past the cursor it started at.
+#
+def ec2_pages(ec2, instance_ids=None, cursor=None, context=None):
+    cursor = cursor or {}
+    filters = [ec2_state_filter]
+    if create_schedule_tag_force != 'True':
+        # Untagged instances are only logged when tags are not forced, so let EC2 leave them out.
+        # The wildcards keep the substring match on the tag key used in ec2_evaluate().
+        filters.append({'Name': 'tag-key', 'Values': ['*' + os.getenv('TAG', 'schedule') + '*']})
+
+    if instance_ids is not None:
+        for page_number, position in enumerate(range(cursor.get('position', 0), len(instance_ids), ec2_filter_size)):
+            if page_number > 0 and out_of_time(context):
+                yield {'position': position}, None
+                return
+            batch_filters = filters + [{'Name': 'instance-id', 'Values': instance_ids[position:position + ec2_filter_size]}]
+            yield {'position': position}, ec2_describe(ec2, batch_filters)
+        return
+
+    token = cursor.get('token')
+    while True:
+        kwargs = {'Filters': filters, 'MaxResults': 1000}
+        if token:
+            kwargs['NextToken'] = token
+        response = ec2.describe_instances(**kwargs)
+        yield {'token': token}, [instance for reservation in response['Reservations'] for instance in reservation['Instances']]
+        token = response.get('NextToken')
+        if not token:
+            break
+        if out_of_time(context):
+            yield {'token': token}, None
+            break
+
+#
+# Yield (cursor, instances) like ec2_pages() from a tag-only pass. tag_pages yields
+# (cursor, [(instance id, schedule tag value)]), only instances with a start or stop due
+# at one of the week hours are described, in batches of ids.
+#
+def ec2_due_pages(ec2, tag_pages, hours):
+    for page_cursor, resources in tag_pages:
+        if resources is None:
+            yield page_cursor, None
+            return
+        due = list(collections.OrderedDict.fromkeys(instance_id for instance_id, data in resources if schedule_due(data, hours)))
+        instances = []
+        for batch in chunks(due, ec2_filter_size):
+            instances.extend(ec2_describe(ec2, [ec2_state_filter, {'Name': 'instance-id', 'Values': batch}]))
+        yield page_cursor, instances
+
+#
+# Tag-only pass over the EC2 instance tags matching the schedule tag, using DescribeTags.
+# Like ec2_pages(), the pages after the first are only fetched while there is time left.
+#
+def ec2_tag_pages(ec2, cursor=None, context=None):
+    schedule_tag = os.getenv('TAG', 'schedule')
+    filters = [{'Name': 'resource-type', 'Values': ['instance']}, {'Name': 'key', 'Values': ['*' + schedule_tag + '*']}]
+    token = (cursor or {}).get('token')
+    while True:
+        kwargs = {'Filters': filters, 'MaxResults': 1000}
+        if token:
+            kwargs['NextToken'] = token
+        response = ec2.describe_tags(**kwargs)
+        yield {'token': token}, [(tag['ResourceId'], tag['Value']) for tag in response['Tags'] if is_schedule_tag(tag['Key'], schedule_tag)]
+        token = response.get('NextToken')
+        if not token:
+            break
+        if out_of_time(context):
+            yield {'token': token}, None
+            break
+
+#
+# Tag-only pass over the EC2 instances carrying the schedule tag, using the Resource Groups Tagging API.
+#
+def ec2_tagging_pages(tagging, cursor=None, context=None):
+    for page_cursor, resources in tagged_resources(tagging, ['ec2:instance'], cursor, context):
+        if resources is None:
+            yield page_cursor, None
+            return
+        yield page_cursor, [(arn.split('/')[-1], data) for arn, data in resources]
+
+def ec2_describe(ec2, filters):
+    paginator = ec2.get_paginator('describe_instances')
+    return [instance for page in paginator.paginate(Filters=filters) for reservation in page['Reservations'] for instance in reservation['Instances']]
+
+#
+# Yield (cursor, [(arn, schedule tag value)]) for every page of resources of resource_types
+# carrying the schedule tag, as returned by the Resource Groups Tagging API.
+# Like ec2_pages(), the pages after the first are only fetched while there is time left.
+#
+def tagged_resources(tagging, resource_types, cursor=None, context=None):
+    schedule_tag = os.getenv('TAG', 'schedule')
+    token = (cursor or {}).get('token')
+    while True:
+        kwargs = {'TagFilters': [{'Key': schedule_tag}], 'ResourceTypeFilters': resource_types}
+        if token:
+            kwargs['PaginationToken'] = token
+        response = tagging.get_resources(**kwargs)
+        resources = []
+        for mapping in response['ResourceTagMappingList']:
+            data = [tag['Value'] for tag in mapping['Tags'] if tag['Key'] == schedule_tag]
+            resources.append((mapping['ResourceARN'], data[0] if data else ''))
+        yield {'token': token}, resources
+        token = response.get('PaginationToken')
+        if not token:
+            break
+        if out_of_time(context):
+            yield {'token': token}, None
+            break
+
+def schedule_due(data, hours):
+    schedule = get_schedule(data)
+    return any(due_states(schedule, wh) for wh in hours)
+
+#
+# True when the Lambda has less than continuation_margin seconds left and the run should continue in a new invocation.
+#
+def out_of_time(context):
+    return context is not None and context.get_remaining_time_in_millis() < continuation_margin * 1000
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+#
+# Start and stop the EC2 instances selected by check() with batched StartInstances/StopInstances requests.
+#
+def ec2_act(ec2, to_start, to_stop):
+    result = {'started': [], 'stopped': [], 'transitions': [], 'failed': []}
+
+    for action, instance_ids, done in (('start', to_start, result['started']), ('stop', to_stop, result['stopped'])):
+        for batch in chunks(instance_ids, ec2_batch_size):
+            transitions = ec2_bisect_action(ec2, action, batch, result['failed'])
+            done.extend(t['InstanceId'] for t in transitions)
+            result['transitions'].extend(transitions)
+
+    for failure in result['failed']:
+        logger.error("Failed to %s EC2 instance \"%s\" : %s" % (failure['Action'], failure['InstanceId'], failure['Error']))
+
+    return result
+
+# Error code of an AWS error, or the exception class name for anything else.
+def error_code(e):
+    response = getattr(e, 'response', None)
+    if isinstance(response, dict):
+        return response.get('Error', {}).get('Code', 'Unknown')
+    return e.__class__.__name__
+
+#
+# Run a batched EC2 action, bisecting a failed batch until the offending instance ids are isolated,
+# so one instance that cannot be started or stopped costs O(log n) extra requests.
+# Isolated failures are appended to failed with their error code.
+#
+def ec2_bisect_action(ec2, action, instance_ids, failed):
+    try:
+        return ec2_batch_action(ec2, action, instance_ids)
+    except Exception as e:
+        code = error_code(e)
+        if len(instance_ids) > 1 and code.split('.')[0] in ec2_instance_errors:
+            logger.info("%s of %i EC2 instances failed with %s, bisecting batch" % (action, len(instance_ids), code))
+            half = len(instance_ids) // 2
+            return ec2_bisect_action(ec2, action, instance_ids[:half], failed) + ec2_bisect_action(ec2, action, instance_ids[half:], failed)
+
+    failed.extend({'InstanceId': instance_id, 'Action': action, 'Error': code} for instance_id in instance_ids)
+    return []
+
+#
+# Issue one StartInstances or StopInstances request and return the per-instance state transitions.
+# action = start | stop
+#
+def ec2_batch_action(ec2, action, instance_ids):
+    logger.info("%s EC2 instances \"%s\"." % ('Starting' if action == 'start' else 'Stopping', ', '.join(instance_ids)))
+    if action == 'start':
+        changes = ec2.start_instances(InstanceIds=instance_ids)['StartingInstances']
+    else:
+        changes = ec2.stop_instances(InstanceIds=instance_ids)['StoppingInstances']
+
+    return [{
+        'InstanceId': change['InstanceId'],
+        'PreviousState': change['PreviousState']['Name'],
+        'CurrentState': change['CurrentState']['Name']
+    } for change in changes]
+
+def rds_init(aws_region, role_arn=None):
+    # Setup AWS connection
+    logger.info("-----> Connecting rds to region \"%s\"", aws_region)
+    rds = get_connection('rds', aws_region, role_arn)
+    logger.info("-----> Connected rds to region \"%s\"", aws_region)
+    return rds
+
+#
+# Add default 'schedule' tag to instance.
+# (Only if instance.id not excluded and create_schedule_tag_force variable is True.
+#
+def rds_create_schedule_tag(rds, instance, object_type):
+    exclude_list = os.environ.get('EXCLUDE').split(',')
+
+    if (create_schedule_tag_force == 'True') and (instance['DB'+object_type+'Identifier'] not in exclude_list):
+        try:
+            schedule_tag =  os.getenv('TAG', 'schedule')
+            tag_default =  rds_default_schedule
+            logger.info("json tag_value: %s" % tag_default)
+
+            if len(tag_default) > 1 and tag_default[0] == '{':
+                tag = json.loads(tag_default)
+                tag_dict = flattenjson(tag, "_")
+                tag_value= dict_to_string(tag_dict)
+            else:
+                # use default string without convert to JSON
+                tag_value=tag_default
+
+            logger.info("About to create %s tag on RDS instance %s with value: %s" % (schedule_tag,instance['DBInstanceIdentifier'],tag_value))
+            tags = [{
+                "Key" : schedule_tag,
+                "Value" : tag_value
+            }]
+            rds.add_tags_to_resource(ResourceName=instance['DB'+object_type+'Arn'],Tags=tags)
+        except Exception as e:
+            logger.error("Error adding Tag to RDS instance: %s" % e)
+    else:
+        logger.info("No 'schedule' tag found on RDS instance %s. Use create_schedule_tag_force option to create the tag automagically" % instance['DB'+object_type+'Identifier'])
+
+def flattenjson( b, delim ):
+    val = {}
+    for i in b.keys():
+        if isinstance( b[i], dict ):
+            get = flattenjson( b[i], delim )
+            for j in get.keys():
+                val[ i + delim + j ] = get[j]
+        else:
+            val[i] = b[i]
+
+    return val
+
+def dict_to_string( d ):
+    val = ""
+    for k, v in d.items():
+         if type(v) is list:
+             vs='/'.join(str(s) for s in v)
+         else:
+             vs=v
+         if len(val) == 0 :
+             val=k+"="+str(vs)
+         else:
+             val=val+" "+k+"="+str(vs)
+
+    return val
+
+
+#
+# Loop RDS instances and check if a 'schedule' tag has been set. Next, evaluate value and start/stop instance if needed.
+#
+def rds_check(rds, context=None, cursor=None, clock=None, tagging=None):
+    clock = clock or get_clock()
+    logger.info("-----> Checking RDS instances to start or stop for 'day' " + clock.day + " " + clock.label + " hour " + str(clock.hour))
+
+    cursor = cursor or {}
+    object_types = ['Instance', 'Cluster']
+    result = {'started': [], 'stopped': [], 'failed': []}
+    # RDS has no batch start/stop API, so the per-resource calls are spread over a bounded thread pool.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=rds_workers) as executor:
+        first_type = cursor.get('object_type', 'Instance')
+        for object_type in object_types[object_types.index(first_type):]:
+            if object_type != first_type and out_of_time(context):
+                logger.info("-----> Running out of time, RDS continues with %ss" % object_type)
+                result['cursor'] = {'object_type': object_type, 'marker': None}
+                break
+            marker = cursor.get('marker') if object_type == cursor.get('object_type') else None
+            if tagging is not None:
+                rds_pages = rds_tagged_describe(rds, tagging, object_type, candidate_hours(clock), marker, context)
+            else:
+                rds_pages = rds_describe(rds, object_type, marker, context)
+            loop_result = rds_loop(rds, rds_pages, clock, object_type, executor)
+            for key in result.keys():
+                result[key].extend(loop_result[key])
+            if 'cursor' in loop_result:
+                result['cursor'] = loop_result['cursor']
+                break
+    return result
+
+
+#
+# Yield (cursor, records) for the RDS instances or clusters one describe page at a time, starting at marker.
+# The cursor is where a continuation resumes. Like ec2_pages(), the pages after the first are only fetched while there is time left.
+#
+def rds_describe(rds, object_type, marker=None, context=None):
+    describe = getattr(rds, 'describe_db_'+object_type.lower()+'s')
+    while True:
+        response = describe(Marker=marker) if marker else describe()
+        yield {'object_type': object_type, 'marker': marker}, response['DB'+object_type+'s']
+        marker = response.get('Marker')
+        if not marker:
+            break
+        if out_of_time(context):
+            yield {'object_type': object_type, 'marker': marker}, None
+            break
+
+#
+# Yield (cursor, records) like rds_describe(), discovering the tagged instances or clusters with the
+# Resource Groups Tagging API. Only those with a start or stop due at one of the week hours are described.
+#
+def rds_tagged_describe(rds, tagging, object_type, hours, marker=None, context=None):
+    resource_type = 'rds:db' if object_type == 'Instance' else 'rds:cluster'
+    filter_name = 'db-instance-id' if object_type == 'Instance' else 'db-cluster-id'
+    describe = getattr(rds, 'describe_db_'+object_type.lower()+'s')
+    for page_cursor, resources in tagged_resources(tagging, [resource_type], {'token': marker}, context):
+        if resources is None:
+            yield {'object_type': object_type, 'marker': page_cursor['token']}, None
+            return
+        due = [arn for arn, data in resources if schedule_due(data, hours)]
+        records = []
+        for batch in chunks(due, 100):
+            records.extend(describe(Filters=[{'Name': filter_name, 'Values': batch}])['DB'+object_type+'s'])
+        yield {'object_type': object_type, 'marker': page_cursor['token']}, records
+
+#
+# Checks the schedule tags for instances or clusters, and stop/starts accordingly.
+# rds_pages is an iterable of describe pages, each page is evaluated and acted on as soon as it arrives.
+# A page of None ends the loop, the rest continues in a new invocation at its cursor.
+#
+def rds_loop(rds, rds_pages, clock, object_type, executor):
+    schedule_tag = os.getenv('TAG', 'schedule')
+    logger.info("-----> schedule tag is called \"%s\"", schedule_tag)
+
+    pending = []
+    page_cursor = None
+    found = 0
+    for page_cursor, page in rds_pages:
+        if page is None:
+            logger.info("-----> Running out of time, RDS continues at %s" % page_cursor)
+            break
+        page_cursor = None
+        found += len(page)
+        to_start, to_stop = rds_evaluate(rds, page, clock, object_type, schedule_tag, executor)
+        pending.extend(rds_act(rds, object_type, to_start, to_stop, executor))
+
+    if found == 0 and object_type == 'Instance' and page_cursor is None and discovery != 'tagging':
+        logger.error('Unable to find any RDS Instances, please check configuration')
+
+    result = {'started': [], 'stopped': [], 'failed': []}
+    if page_cursor is not None:
+        result['cursor'] = page_cursor
+    for future, action, identifier in pending:
+        try:
+            future.result()
+            result['started' if action == 'start' else 'stopped'].append(identifier)
+        except Exception as e:
+            logger.info("ERROR rds_loop \"%s\" " % (e))
+            code = error_code(e)
+            result['failed'].append({'Identifier': identifier, 'Action': action, 'Error': code})
+
+    return result
+
+#
+# Select the RDS instances or clusters of one describe page that need to be started or stopped.
+#
+def rds_evaluate(rds, rds_objects, clock, object_type, schedule_tag, executor):
+    buckets = collections.OrderedDict()
+    for instance in rds_objects:
+        if 'DBInstanceStatus' not in instance: instance['DBInstanceStatus'] = ''
+        if 'Status' not in instance: instance['Status'] = ''
+        logger.info("-----> Evaluating RDS instance \"%s\" state: %s" % (instance['DB'+object_type+'Identifier'], instance['DBInstanceStatus']))
+        # describe_db_instances/describe_db_clusters include the tags, only older records need a lookup.
+        if 'TagList' in instance:
+            taglist = instance['TagList']
+        else:
+            taglist = rds.list_tags_for_resource(ResourceName=instance['DB'+object_type+'Arn'])['TagList']
+
+        data = ""
+        for tag in taglist:
+            if is_schedule_tag(tag['Key'], schedule_tag):
+                data = tag['Value']
+                break
+        else:
+            executor.submit(rds_create_schedule_tag, rds, instance, object_type)
+
+        wh = resource_week_hour(taglist, clock)
+        buckets.setdefault((data, wh), []).append(instance)
+
+    to_start = []
+    to_stop = []
+    for data, state, members in evaluate_buckets(buckets):
+        if state == 'start':
+            to_start.extend(instance['DB'+object_type+'Identifier'] for instance in members if instance['DBInstanceStatus'] == 'stopped' or instance['Status'] == 'stopped')
+        else:
+            to_stop.extend(instance['DB'+object_type+'Identifier'] for instance in members if instance['DBInstanceStatus'] == 'available' or instance['Status'] == 'available')
+
+    return to_start, to_stop
+
+#
+# Submit the start and stop calls for the RDS instances or clusters selected by rds_evaluate().
+# Returns a list of (future, action, identifier) for rds_loop() to collect.
+#
+def rds_act(rds, object_type, to_start, to_stop, executor):
+    pending = []
+    for action, identifiers in (('start', to_start), ('stop', to_stop)):
+        for identifier in identifiers:
+            pending.append((executor.submit(rds_action, rds, object_type, action, identifier), action, identifier))
+    return pending
+
+# action = start | stop
+def rds_action(rds, object_type, action, identifier):
+    if action == 'start':
+        logger.info("-----> Starting RDS instance \"%s\"." %(identifier))
+        if object_type == 'Instance': rds.start_db_instance(DBInstanceIdentifier=identifier)
+        if object_type == 'Cluster': rds.start_db_cluster(DBClusterIdentifier=identifier)
+    else:
+        logger.info("-----> Stopping RDS instance \"%s\"." %(identifier))
+        if object_type == 'Instance': rds.stop_db_instance(DBInstanceIdentifier=identifier)
+        if object_type == 'Cluster': rds.stop_db_cluster(DBClusterIdentifier=identifier)
+
+
+#
+# Stores persist the active hours index between invocations. LocalFileIndexStore keeps it in a
+# file, which lasts as long as the Lambda execution environment. Other stores only need load() and save().
+#
+class LocalFileIndexStore(object):
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def save(self, index):
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(self.path + '.tmp', self.path)
+
+# Set to None to disable the active hours index and early exit.
+index_store = LocalFileIndexStore(os.getenv('INDEX_FILE', '/tmp/aws-scheduler-index.json')) if early_exit == 'True' else None
+
+# Settings that change which schedules apply, an index built with other settings is not used.
+def index_fingerprint(role_arns):
+    return json.dumps([os.getenv('TAG', 'schedule'), time_zone, create_schedule_tag_force, ec2_default_schedule,
+                       ec2_schedule, rds_schedule, regions, role_arns, discovery, reconcile, timezone_tag])
+
+#
+# The active hours index is the union of the start and stop masks of every schedule seen by the last
+# complete run. When it has no transition at week hour wh nothing can happen, so the run can be skipped.
+#
+def index_allows_skip(index, fingerprint, wh, run_time):
+    if index is None or index.get('fingerprint') != fingerprint:
+        return False
+    if run_time - index['refreshed'] > index_max_age * 3600:
+        logger.info("-----> Active hours index is older than %i hours, refreshing" % index_max_age)
+        return False
+    if reconcile == 'True':
+        # A start or stop since the index was saved may not have been applied yet.
+        due = next_transition(index, index['refreshed'])
+        return due is None or due > run_time
+    return not is_due(CompiledSchedule(index['start'], 0), 'start', wh) and not is_due(CompiledSchedule(0, index['stop']), 'stop', wh)
+
+def save_index(fingerprint, run_time, active):
+    index_store.save({'fingerprint': fingerprint, 'refreshed': run_time, 'start': active['start'], 'stop': active['stop']})
+    logger.info("-----> Saved active hours index with %i start and %i stop hours" % (bin(active['start']).count('1'), bin(active['stop']).count('1')))
+
+# Union of the start and stop hours of the schedules seen by this run.
+def active_hours():
+    if timezone_tag:
+        # The hours of resources in another time zone are not known in the run's time zone, so any hour can have one.
+        return {'start': (1 << 168) - 1, 'stop': (1 << 168) - 1}
+    active = dict(run_active_hours)
+    if create_schedule_tag_force == 'True':
+        # Instances tagged with a default schedule during the run were evaluated before they had one.
+        for default in (ec2_default_schedule, rds_default_schedule):
+            schedule = compile_schedule(default)
+            active['start'] |= schedule.start
+            active['stop'] |= schedule.stop
+    return active
+
+# True when no phase of the run summary reported an error or continues in another invocation.
+# With reconcile a failed start or stop is retried by the next run, so that run must not be skipped either.
+def run_complete(summary):
+    if not isinstance(summary, dict):
+        return True
+    if 'error' in summary or 'cursor' in summary:
+        return False
+    if reconcile == 'True' and summary.get('failed'):
+        return False
+    return all(run_complete(value) for value in summary.values())
+
+#
+# Adaptive wake-up: after a complete run the EventBridge rule is set to the next hour at which a
+# known schedule has a start or stop, and at least every index_max_age hours to pick up new schedule tags.
+# A run sets the rule back to schedule_expression before it starts, so a run that times out or is killed
+# does not leave the rule at a wake-up a day away.
+#
+adaptive_wakeup = os.getenv('ADAPTIVE_WAKEUP', 'False').capitalize()
+rule_name = os.getenv('RULE_NAME', 'check-scheduler-event')
+wakeup_minute = int(os.getenv('WAKEUP_MINUTE', '5'))
+# The rule is set back to this expression after a run that did not complete.
+default_schedule_expression = os.getenv('SCHEDULE_EXPRESSION', 'cron(5 * * * ? *)')
+
+# Set to an EventBridge client to override the one used for adaptive wake-up.
+events_client = None
+
+# Seconds east of UTC of the configured time zone at run_time.
+def utc_offset(run_time):
+    if time_zone == 'local':
+        return time.localtime(run_time).tm_gmtoff
+    elif time_zone == 'gmt':
+        return 0
+    return zone_offset(time_zone_info, run_time) * 60
+
+# Start, as a UTC timestamp, of the local hour after run_time at which a start or stop in active falls. None without one.
+def next_transition(active, run_time):
+    hour_start = run_time - (run_time + utc_offset(run_time)) % 3600
+    hours = active['start'] | active['stop']
+    for ahead in range(1, 169):
+        day, hh, time_label = local_day_hour(hour_start + ahead * 3600)
+        if hours >> week_hour(day, hh) & 1:
+            return hour_start + ahead * 3600
+    return None
+
+def next_action(active, run_time):
+    due = next_transition(active, run_time)
+    if due is None:
+        return None
+    day, hh, time_label = local_day_hour(due)
+    return {'day': day, 'hour': hh, 'time': datetime.datetime.utcfromtimestamp(due).strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+# A daily cron expression in UTC, so a missed invocation is repeated a day later rather than never.
+# Wake-ups are at most a day ahead, so the first time the expression fires is wake_time.
+def wakeup_expression(wake_time):
+    d = datetime.datetime.utcfromtimestamp(wake_time)
+    return 'cron(%i %i * * ? *)' % (d.minute, d.hour)
+
+def get_events():
+    if events_client is not None:
+        return events_client
+    return get_connection('events', aws_region)
+
+def set_wakeup(active, run_time, complete):
+    if complete:
+        due = next_transition(active, run_time)
+        latest = run_time - (run_time + utc_offset(run_time)) % 3600 + min(index_max_age, 24) * 3600
+        expression = wakeup_expression(min(due, latest) + wakeup_minute * 60 if due is not None else latest + wakeup_minute * 60)
+    else:
+        expression = default_schedule_expression
+    return put_wakeup(expression)
+
+def put_wakeup(expression):
+    events = get_events()
+    # PutRule replaces the whole rule, so the settings that are not changed are passed back.
+    rule = events.describe_rule(Name=rule_name)
+    if rule.get('ScheduleExpression') == expression:
+        return expression
+    logger.info("-----> Setting rule \"%s\" to \"%s\"" % (rule_name, expression))
+    settings = {key: rule[key] for key in ('Description', 'State', 'RoleArn', 'EventBusName') if key in rule}
+    events.put_rule(Name=rule_name, ScheduleExpression=expression, **settings)
+    return expression
+
+def ec2_phase(region, role_arn=None, context=None, clock=None, instance_ids=None, cursor=None):
+    return check(init(region, role_arn), instance_ids, context, cursor, clock, tagging_init(region, role_arn))
+
+def rds_phase(region, role_arn=None, context=None, clock=None, cursor=None):
+    return rds_check(rds_init(region, role_arn), context, cursor, clock, tagging_init(region, role_arn))
+
+# Returns the Resource Groups Tagging API client when it is the discovery backend, None otherwise.
+def tagging_init(region, role_arn=None):
+    if discovery != 'tagging':
+        return None
+    return get_connection('resourcegroupstaggingapi', region, role_arn)
+
+#
+# Run one scheduling phase for a region and time it. Errors are caught and reported so they do not affect other phases.
+# A phase that ran out of time returns a cursor, and the rest of it is handed to a continuation invocation.
+#
+def run_phase(name, phase, region, role_arn=None, context=None, clock=None, **kwargs):
+    clock = clock or get_clock()
+    phase_start = time.time()
+    try:
+        result = phase(region, role_arn, context, clock, **kwargs)
+        if 'cursor' in result:
+            shard = dict(kwargs, role_arn=role_arn, region=region, phase=name, cursor=result['cursor'], run_time=clock.instant)
+            get_invoker(context).invoke({'shard': shard})
+            logger.info("-----> %s phase for region \"%s\" continues in a new invocation" % (name, region))
+    except Exception as e:
+        logger.exception("Error in %s phase for region \"%s\" : %s" % (name, region, e))
+        result = {'error': str(e)}
+    result['duration'] = round(time.time() - phase_start, 3)
+    logger.info("-----> %s phase for region \"%s\" finished in %.3f seconds" % (name, region, result['duration']))
+    return result
+
+def enabled_phases():
+    phases = collections.OrderedDict()
+    if (ec2_schedule == 'True'):
+        phases['ec2'] = ec2_phase
+    if (rds_schedule == 'True'):
+        phases['rds'] = rds_phase
+    return phases
+
+#
+# Run every enabled phase in every region for one account, role_arn None being the Lambda's own account.
+#
+def schedule_account(role_arn=None, context=None, clock=None):
+    phases = enabled_phases()
+
+    if role_arn:
+        try:
+            get_session(role_arn)
+        except Exception as e:
+            logger.exception("Error assuming role \"%s\" : %s" % (role_arn, e))
+            return {'error': str(e)}
+
+    # Every region and phase is independent, so run them all side by side.
+    summary = collections.OrderedDict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(regions) * len(phases), 1)) as executor:
+        futures = [(region, name, executor.submit(run_phase, name, phase, region, role_arn, context, clock)) for region in regions for name, phase in phases.items()]
+        for region, name, future in futures:
+            summary.setdefault(region, {})[name] = future.result()
+    return summary
+
+#
+# Run account_fn for the Lambda's own account, or for every role arn through a bounded pool.
+# An error in one account does not affect the others.
+#
+def for_each_account(role_arns, account_fn):
+    if not role_arns:
+        return account_fn(None)
+
+    summary = collections.OrderedDict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=account_workers) as executor:
+        futures = [(role_arn, executor.submit(account_fn, role_arn)) for role_arn in role_arns]
+        for role_arn, future in futures:
+            summary[role_arn] = future.result()
+    return summary
+
+#
+# Invokers start a worker invocation for a shard or a continuation. LambdaInvoker asynchronously invokes this Lambda function,
+# LocalInvoker runs the worker in-process and keeps its result, e.g. for testing.
+#
+class LambdaInvoker(object):
+    def __init__(self, function_name, region):
+        self.function_name = function_name
+        self.region = region
+
+    def invoke(self, event):
+        get_connection('lambda', self.region).invoke(FunctionName=self.function_name, InvocationType='Event', Payload=json.dumps(event))
+
+class LocalInvoker(object):
+    def __init__(self):
+        self.results = []
+
+    def invoke(self, event):
+        self.results.append(handler(event, None))
+
+# Set to an invoker to override the LambdaInvoker used for shards and continuations.
+shard_invoker = None
+
+def get_invoker(context):
+    if shard_invoker is not None:
+        return shard_invoker
+    function_name = context.function_name if context else os.getenv('AWS_LAMBDA_FUNCTION_NAME')
+    return LambdaInvoker(function_name, aws_region)
+
+#
+# Coordinator mode: split one account's fleet into shards and start a worker invocation for each.
+# EC2 instances are split into shards of shard_size instance ids, RDS is one shard per region.
+#
+def coordinate_account(role_arn, invoker, clock, context=None):
+    summary = collections.OrderedDict()
+    for region in regions:
+        summary[region] = coordinate_region(role_arn, region, invoker, clock, context)
+    return summary
+
+#
+# Start the worker invocations of one region. The EC2 instance ids are listed a page at a time and each shard is
+# started as soon as it is full. When the Lambda runs low on time the rest of the listing is handed to a coordinator
+# continuation, which starts at cursor.
+#
+def coordinate_region(role_arn, region, invoker, clock, context=None, cursor=None):
+    result = {'shards': 0}
+    try:
+        if (rds_schedule == 'True') and cursor is None:
+            invoker.invoke({'shard': {'role_arn': role_arn, 'region': region, 'phase': 'rds', 'run_time': clock.instant}})
+            result['shards'] += 1
+        if (ec2_schedule == 'True'):
+            instance_ids = []
+            for page_cursor, page in ec2_pages(init(region, role_arn), cursor=cursor, context=context):
+                if page is None:
+                    logger.info("-----> Running out of time, sharding region \"%s\" continues at %s" % (region, page_cursor))
+                    result['cursor'] = page_cursor
+                    break
+                instance_ids.extend(instance['InstanceId'] for instance in page)
+                # Full shards are started straight away, the last one once the listing stops.
+                full = len(instance_ids) - len(instance_ids) % shard_size
+                result['shards'] += start_ec2_shards(invoker, role_arn, region, instance_ids[:full], clock)
+                instance_ids = instance_ids[full:]
+            result['shards'] += start_ec2_shards(invoker, role_arn, region, instance_ids, clock)
+            if 'cursor' in result:
+                invoker.invoke({'coordinate': {'role_arn': role_arn, 'region': region, 'cursor': result['cursor']}, 'run_time': clock.instant})
+        logger.info("-----> Started %i worker invocations for region \"%s\"" % (result['shards'], region))
+    except Exception as e:
+        logger.exception("Error sharding region \"%s\" : %s" % (region, e))
+        result = {'error': str(e)}
+    return result
+
+def start_ec2_shards(invoker, role_arn, region, instance_ids, clock):
+    shards = 0
+    for batch in chunks(instance_ids, shard_size):
+        invoker.invoke({'shard': {'role_arn': role_arn, 'region': region, 'phase': 'ec2', 'instance_ids': batch, 'run_time': clock.instant}})
+        shards += 1
+    return shards
+
+#
+# Worker mode: run the phase of one shard or continuation. The shard carries the run time of the
+# invocation that created it, so every shard and continuation evaluates the same hour.
+#
+def run_shard(shard, context=None, clock=None):
+    name = shard['phase']
+    kwargs = dict((key, shard[key]) for key in ('instance_ids', 'cursor') if key in shard)
+    result = run_phase(name, enabled_phases()[name], shard['region'], shard.get('role_arn'), context, clock or get_clock(shard.get('run_time')), **kwargs)
+    return {shard['region']: {name: result}}
+
+# Main function. Entrypoint for Lambda
+def handler(event, context):
+    event = event or {}
+    # Shards and the coordinator do not see every schedule, so only a plain run uses the known schedules.
+    plain_run = 'shard' not in event and 'coordinate' not in event and shard_size == 0
+    try:
+        summary = run(event, context, plain_run)
+    except Exception:
+        # With adaptive wake-up the rule may be a daily cron, so a failed run sets it back to schedule_expression
+        # rather than leave the scheduler asleep until tomorrow.
+        if plain_run and adaptive_wakeup == 'True':
+            try:
+                put_wakeup(default_schedule_expression)
+            except Exception as e:
+                logger.exception("Error setting rule \"%s\": %s" % (rule_name, e))
+        raise
+
+    log_schedule_cache_stats()
+    return summary
+
+def run(event, context, plain_run):
+    role_arns = event.get('role_arns', default_role_arns)
+    clock = get_clock(event['shard'].get('run_time') if 'shard' in event else event.get('run_time'))
+
+    use_index = index_store is not None and plain_run
+    summary = None
+    if use_index:
+        fingerprint = index_fingerprint(role_arns)
+        index = index_store.load()
+        if index_allows_skip(index, fingerprint, clock.week_hour, clock.instant):
+            logger.info("-----> No schedule has a transition on 'day' %s %s hour %i, nothing to do" % (clock.day, clock.label, clock.hour))
+            summary = {'skipped': True}
+            active = {'start': index['start'], 'stop': index['stop']}
+
+    if summary is None:
+        if plain_run and adaptive_wakeup == 'True':
+            put_wakeup(default_schedule_expression)
+        run_active_hours.update({'start': 0, 'stop': 0})
+        if 'shard' in event:
+            summary = run_shard(event['shard'], context, clock)
+        elif 'coordinate' in event:
+            coordinate = event['coordinate']
+            summary = {coordinate['region']: coordinate_region(coordinate.get('role_arn'), coordinate['region'], get_invoker(context), clock, context, coordinate['cursor'])}
+        elif shard_size > 0:
+            invoker = get_invoker(context)
+            summary = for_each_account(role_arns, lambda role_arn: coordinate_account(role_arn, invoker, clock, context))
+        else:
+            summary = for_each_account(role_arns, lambda role_arn: schedule_account(role_arn, context, clock))
+        active = active_hours()
+        if use_index and run_complete(summary):
+            save_index(fingerprint, clock.instant, active)
+
+    if plain_run:
+        complete = run_complete(summary)
+        summary['next_action'] = next_action(active, clock.instant) if complete else None
+        if adaptive_wakeup == 'True':
+            summary['wakeup'] = set_wakeup(active, clock.instant, complete)
+
+    return summary
+
+# Manual invocation of the script (only used for testing)
+if __name__ == "__main__":
+    # Test data
+    test = {}
+    handler(test, None)
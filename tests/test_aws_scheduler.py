@@ -0,0 +1,635 @@
+import collections, concurrent.futures, copy, datetime, fnmatch, importlib.util, json, os, sys, threading
+
+import pytest
+
+package_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'package')
+sys.path.insert(0, package_dir)
+
+from botocore.exceptions import ClientError
+
+import pytz
+
+# The scheduler reads its settings from the environment when it is imported, so each setting gets its own module.
+def load_scheduler(**env):
+    saved = dict(os.environ)
+    os.environ.update({'AWS_REGION': 'us-east-1'}, **env)
+    try:
+        spec = importlib.util.spec_from_file_location('aws_scheduler', os.path.join(package_dir, 'aws-scheduler.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+scheduler = load_scheduler()
+
+#
+# checkdate() as it was before schedules were compiled, the behaviour the compiled schedules must keep.
+#
+def baseline_checkdate(data, state, day, hh):
+    schedule = {}
+    if data == '':
+        return False
+    elif len(data) > 1 and data[0] == '{':
+        schedule = json.loads(data)
+    else:
+        t = dict(x.split('=') for x in ' '.join(data.split()).split(' '))
+        for d in t.keys():
+            dday, datastate = d.split('_')
+            schedule.setdefault(dday, {})[datastate] = [int(i) for i in t[d].split('/')]
+
+    schedule_data = []
+    if day in schedule.keys() and state in schedule[day]:
+        schedule_data = schedule[day][state] if type(schedule[day][state]) is list else [schedule[day][state]]
+    if 'daily' in schedule.keys() and state in schedule['daily']:
+        schedule_data.extend(schedule['daily'][state] if type(schedule['daily'][state]) is list else [int(schedule['daily'][state])])
+    if day in ['mon', 'tue', 'wed', 'thu', 'fri'] and 'workday' in schedule.keys() and state in schedule['workday']:
+        schedule_data.extend(schedule['workday'][state] if type(schedule['workday'][state]) is list else [schedule['workday'][state]])
+    return int(hh) in schedule_data
+
+schedules = [
+    '{"mon": {"start": [7], "stop": [19]},"tue": {"start": [7], "stop": [19]},"wed": {"start": [9, 22], "stop": [19]},"thu": {"start": [7], "stop": [2,19]}, "fri": {"start": [7], "stop": [19]}, "sat": {"start": [22]}, "sun": {"stop": [7]}}',
+    '{"mon": {"start": 7, "stop": 20},"tue": {"start": 7, "stop": 20},"wed": {"start": 7, "stop": 20},"thu": {"start": 7, "stop": 20}, "fri": {"start": 7, "stop": 20}}',
+    '{"daily": {"stop": [19, 23, 4]}, "sat": {"stop": 15}, "sun": {"stop": [15]}}',
+    '{"workday": {"start": 8, "stop": [18]}, "daily": {"start": 3}}',
+    'mon_start=7 mon_stop=20 tue_start=7 tue_stop=20 wed_start=7/22 wed_stop=20   thu_start=7 thu_stop=2/20 fri_start=7 fri_stop=20',
+    'daily_stop=19',
+    '',
+    '{}',
+    # Invalid entries do not affect the valid ones.
+    '{"mon": {"start": 7}, "sat": {"stop": ["x"]}}',
+    '{"workday": {"stop": 19}, "sun": {"start": [9], "stop": ["x"]}}',
+]
+
+@pytest.mark.parametrize('data', schedules)
+def test_compiled_schedule_matches_baseline_checkdate(data):
+    compiled = scheduler.compile_schedule(data)
+    for day in scheduler.DAYS:
+        for hh in range(24):
+            for state in ('start', 'stop'):
+                assert scheduler.is_due(compiled, state, scheduler.week_hour(day, hh)) == baseline_checkdate(data, state, day, hh), (day, hh, state)
+
+def test_invalid_schedule_data():
+    assert scheduler.compile_schedule('{"mon": ') == scheduler.EMPTY_SCHEDULE
+    assert scheduler.compile_schedule('mon_start=x') == scheduler.EMPTY_SCHEDULE
+    assert scheduler.compile_schedule('{"daily": {"start": "x", "stop": 19}, "tue": 7}') == scheduler.compile_schedule('{"daily": {"stop": 19}}')
+
+def test_last_transition():
+    compiled = scheduler.compile_schedule('{"workday": {"start": 7, "stop": 19}}')
+    wh = scheduler.week_hour
+    assert scheduler.last_transition(compiled, wh('mon', 7)) == 'start'
+    assert scheduler.last_transition(compiled, wh('mon', 12)) == 'start'
+    assert scheduler.last_transition(compiled, wh('mon', 19)) == 'stop'
+    # The friday stop is the most recent transition over the weekend, going back across the start of the week.
+    assert scheduler.last_transition(compiled, wh('mon', 3)) == 'stop'
+    assert scheduler.last_transition(compiled, wh('sun', 12)) == 'stop'
+    assert scheduler.last_transition(scheduler.EMPTY_SCHEDULE, wh('mon', 3)) is None
+
+def test_last_transition_skips_hours_with_start_and_stop():
+    compiled = scheduler.compile_schedule('{"mon": {"start": [5, 9], "stop": 9}}')
+    assert scheduler.last_transition(compiled, scheduler.week_hour('mon', 10)) == 'start'
+    assert scheduler.last_transition(scheduler.compile_schedule('{"mon": {"start": 9, "stop": 9}}'), 0) is None
+
+@pytest.mark.parametrize('zone', ['Europe/London', 'America/New_York', 'Asia/Kolkata', 'Asia/Kathmandu', 'Australia/Adelaide'])
+def test_zone_day_hour_matches_pytz(zone):
+    zoned = load_scheduler(TIME=zone)
+    # Every hour for a year, DST changes included.
+    start = 1704067200
+    for run_time in range(start, start + 366 * 86400, 3600 + 60):
+        local = pytz.utc.localize(datetime.datetime.utcfromtimestamp(run_time)).astimezone(pytz.timezone(zone))
+        assert zoned.zone_day_hour(zoned.time_zone_info, run_time) == (local.strftime('%a').lower(), local.hour), run_time
+
+def test_unknown_time_zone():
+    zoned = load_scheduler(TIME='Nowhere/Zone')
+    assert zoned.time_zone_info is None
+    assert zoned.load_timezone('../zoneinfo') is None
+    with pytest.raises(ValueError):
+        zoned.get_clock(0)
+
+def test_clock_time_overrides_the_current_time():
+    scheduler.clock_time = lambda: 1700000000
+    try:
+        clock = scheduler.get_clock()
+    finally:
+        scheduler.clock_time = None
+    # 2023-11-14 22:13 UTC
+    assert clock == scheduler.Clock(1700000000, 'tue', 22, scheduler.week_hour('tue', 22), "'gmt'")
+
+def test_next_action():
+    active = {'start': 1 << scheduler.week_hour('wed', 7), 'stop': 0}
+    assert scheduler.next_action(active, 1700000000) == {'day': 'wed', 'hour': 7, 'time': '2023-11-15T07:00:00Z'}
+    assert scheduler.next_action({'start': 0, 'stop': 0}, 1700000000) is None
+
+# Stands in for the EC2 client, failing StopInstances with code for any request that includes a bad id.
+class FakeEC2(object):
+    def __init__(self, code, bad_ids=None):
+        self.code = code
+        self.bad_ids = bad_ids
+        self.calls = 0
+
+    def stop_instances(self, InstanceIds):
+        self.calls += 1
+        if self.bad_ids is None or set(InstanceIds) & set(self.bad_ids):
+            raise ClientError({'Error': {'Code': self.code}}, 'StopInstances')
+        return {'StoppingInstances': [{'InstanceId': i, 'PreviousState': {'Name': 'running'}, 'CurrentState': {'Name': 'stopping'}} for i in InstanceIds]}
+
+instance_ids = ['i-%03i' % i for i in range(100)]
+
+def bisect(ec2, instance_ids, failed):
+    return scheduler.ec2_bisect_action(ec2, 'stop', instance_ids, failed)
+
+@pytest.mark.parametrize('code', ['IncorrectInstanceState', 'InvalidInstanceID.NotFound'])
+def test_bisect_isolates_failing_instances(code):
+    ec2 = FakeEC2(code, ['i-042'])
+    failed = []
+    transitions = bisect(ec2, instance_ids, failed)
+    assert failed == [{'InstanceId': 'i-042', 'Action': 'stop', 'Error': code}]
+    assert len(transitions) == 99
+    assert ec2.calls <= 2 * 7 + 1
+
+@pytest.mark.parametrize('code', ['UnauthorizedOperation', 'InternalError', 'RequestLimitExceeded'])
+def test_bisect_fails_whole_batch_on_request_errors(code):
+    ec2 = FakeEC2(code)
+    failed = []
+    assert bisect(ec2, instance_ids, failed) == []
+    assert ec2.calls == 1
+    assert [f['InstanceId'] for f in failed] == instance_ids
+
+def test_index_allows_skip():
+    wh = scheduler.week_hour('mon', 7)
+    index = {'fingerprint': 'f', 'refreshed': 1000, 'start': 1 << wh, 'stop': 0}
+    assert scheduler.index_allows_skip(None, 'f', wh + 1, 2000) is False
+    assert scheduler.index_allows_skip(index, 'other', wh + 1, 2000) is False
+    assert scheduler.index_allows_skip(index, 'f', wh, 2000) is False
+    assert scheduler.index_allows_skip(index, 'f', wh + 1, 2000) is True
+    assert scheduler.index_allows_skip(index, 'f', wh + 1, 1000 + (scheduler.index_max_age + 1) * 3600) is False
+
+def test_index_allows_skip_with_reconcile():
+    reconciling = load_scheduler(RECONCILE='true')
+    # Refreshed at monday 06:00 UTC (1704693600), with a start at monday 07:00.
+    index = {'fingerprint': 'f', 'refreshed': 1704693600, 'start': 1 << reconciling.week_hour('mon', 7), 'stop': 0}
+    wh = reconciling.week_hour('mon', 8)
+    # The start has not been seen by a complete run yet, so a later hour is not skipped either.
+    assert reconciling.index_allows_skip(index, 'f', wh, 1704693600 + 2 * 3600) is False
+    assert reconciling.index_allows_skip(index, 'f', wh, 1704693600 + 1800) is True
+
+def test_run_complete():
+    failed = {'us-east-1': {'ec2': {'started': [], 'failed': [{'InstanceId': 'i-1', 'Action': 'start', 'Error': 'InternalError'}]}}}
+    assert scheduler.run_complete({'us-east-1': {'ec2': {'started': [], 'failed': []}, 'rds': {'started': []}}}) is True
+    assert scheduler.run_complete({'us-east-1': {'ec2': {'cursor': {}}}}) is False
+    assert scheduler.run_complete({'arn': {'error': 'AccessDenied'}}) is False
+    assert scheduler.run_complete(failed) is True
+    # With reconcile the failed start is retried by the next run.
+    assert load_scheduler(RECONCILE='true').run_complete(failed) is False
+
+# Stands in for the EventBridge client, keeping one rule.
+class FakeEvents(object):
+    def __init__(self, expression):
+        self.rule = {'Name': 'check-scheduler-event', 'Arn': 'arn', 'ScheduleExpression': expression, 'State': 'ENABLED',
+                     'Description': 'scheduler', 'EventBusName': 'default'}
+        self.puts = []
+
+    def describe_rule(self, Name):
+        return dict(self.rule)
+
+    def put_rule(self, **kwargs):
+        self.puts.append(kwargs)
+        self.rule.update(kwargs)
+
+def test_put_wakeup_keeps_the_rule_settings():
+    events = FakeEvents('cron(5 * * * ? *)')
+    scheduler.events_client = events
+    try:
+        assert scheduler.put_wakeup('cron(5 7 * * ? *)') == 'cron(5 7 * * ? *)'
+        assert scheduler.put_wakeup('cron(5 7 * * ? *)') == 'cron(5 7 * * ? *)'
+    finally:
+        scheduler.events_client = None
+    assert events.puts == [{'Name': 'check-scheduler-event', 'ScheduleExpression': 'cron(5 7 * * ? *)', 'State': 'ENABLED',
+                            'Description': 'scheduler', 'EventBusName': 'default'}]
+
+def test_adaptive_wakeup_resets_the_rule_before_the_run():
+    waking = load_scheduler(ADAPTIVE_WAKEUP='true', EC2_SCHEDULE='false', RDS_SCHEDULE='false')
+    waking.events_client = FakeEvents('cron(5 7 * * ? *)')
+    expressions = []
+    waking.for_each_account = lambda role_arns, account_fn: expressions.append(waking.events_client.rule['ScheduleExpression']) or {}
+    # wednesday 2023-11-15 10:00 UTC, with nothing due the rule is set to the same time tomorrow.
+    summary = waking.handler({'run_time': 1700042400}, None)
+    assert expressions == ['cron(5 * * * ? *)']
+    assert summary['wakeup'] == waking.events_client.rule['ScheduleExpression'] == 'cron(5 10 * * ? *)'
+
+def test_adaptive_wakeup_keeps_the_default_after_a_failed_run():
+    waking = load_scheduler(ADAPTIVE_WAKEUP='true', EC2_SCHEDULE='false', RDS_SCHEDULE='false')
+    waking.events_client = FakeEvents('cron(5 7 * * ? *)')
+    def timeout(role_arns, account_fn):
+        raise RuntimeError('Task timed out')
+    waking.for_each_account = timeout
+    with pytest.raises(RuntimeError):
+        waking.handler({'run_time': 1700042400}, None)
+    assert waking.events_client.rule['ScheduleExpression'] == 'cron(5 * * * ? *)'
+
+def tag_list(**tags):
+    return [{'Key': key, 'Value': value} for key, value in tags.items()]
+
+def matches(value, patterns):
+    return any(fnmatch.fnmatchcase(value, pattern) for pattern in patterns)
+
+# Paginates a fake client's describe call by following its NextToken.
+class FakePaginator(object):
+    def __init__(self, describe):
+        self.describe = describe
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.describe(**kwargs)
+            yield page
+            if not page.get('NextToken'):
+                break
+            kwargs['NextToken'] = page['NextToken']
+
+# Stands in for the EC2 client with a fleet of instances, returning page_size results per page.
+class FakeEC2Client(object):
+    def __init__(self, instances, page_size=1000):
+        self.instances = collections.OrderedDict((instance['InstanceId'], instance) for instance in instances)
+        self.page_size = page_size
+        self.calls = collections.Counter()
+        self.described = []
+
+    def filter_instances(self, filters):
+        instances = list(self.instances.values())
+        for f in filters:
+            if f['Name'] == 'instance-state-name':
+                instances = [i for i in instances if i['State']['Name'] in f['Values']]
+            elif f['Name'] == 'tag-key':
+                instances = [i for i in instances if any(matches(tag['Key'], f['Values']) for tag in i.get('Tags', []))]
+            elif f['Name'] == 'instance-id':
+                instances = [i for i in instances if i['InstanceId'] in f['Values']]
+        return instances
+
+    def page(self, items, MaxResults=None, NextToken=None):
+        start = int(NextToken or 0)
+        end = start + min(MaxResults or self.page_size, self.page_size)
+        return items[start:end], str(end) if end < len(items) else None
+
+    def describe_instances(self, Filters=(), MaxResults=None, NextToken=None):
+        self.calls['describe_instances'] += 1
+        instances, token = self.page(self.filter_instances(Filters), MaxResults, NextToken)
+        self.described.extend(instance['InstanceId'] for instance in instances)
+        response = {'Reservations': [{'Instances': [copy.deepcopy(instance)]} for instance in instances]}
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def describe_tags(self, Filters=(), MaxResults=None, NextToken=None):
+        self.calls['describe_tags'] += 1
+        keys = [f['Values'] for f in Filters if f['Name'] == 'key'][0]
+        tags = [dict(tag, ResourceId=instance['InstanceId'], ResourceType='instance')
+                for instance in self.instances.values() for tag in instance.get('Tags', []) if matches(tag['Key'], keys)]
+        tags, token = self.page(tags, MaxResults, NextToken)
+        response = {'Tags': tags}
+        if token:
+            response['NextToken'] = token
+        return response
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+    def change_state(self, InstanceIds, previous, current):
+        changes = []
+        for instance_id in InstanceIds:
+            state = self.instances[instance_id]['State']
+            changes.append({'InstanceId': instance_id, 'PreviousState': {'Name': state['Name']}, 'CurrentState': {'Name': current}})
+            state['Name'] = current
+        return changes
+
+    def start_instances(self, InstanceIds):
+        self.calls['start_instances'] += 1
+        return {'StartingInstances': self.change_state(InstanceIds, 'stopped', 'running')}
+
+    def stop_instances(self, InstanceIds):
+        self.calls['stop_instances'] += 1
+        return {'StoppingInstances': self.change_state(InstanceIds, 'running', 'stopped')}
+
+    def create_tags(self, Resources, Tags):
+        for instance_id in Resources:
+            self.instances[instance_id].setdefault('Tags', []).extend(Tags)
+
+def ec2_instance(instance_id, state, **tags):
+    return {'InstanceId': instance_id, 'State': {'Name': state}, 'Tags': tag_list(**tags)}
+
+# Stands in for the RDS client with DB instances and clusters, returning page_size records per page.
+class FakeRDS(object):
+    def __init__(self, instances=(), clusters=(), page_size=100):
+        self.records = {'Instance': list(instances), 'Cluster': list(clusters)}
+        self.page_size = page_size
+        self.calls = collections.Counter()
+        self.lock = threading.Lock()
+
+    def describe(self, object_type, Marker=None, Filters=()):
+        with self.lock:
+            self.calls['describe_db_%ss' % object_type.lower()] += 1
+        records = self.records[object_type]
+        for f in Filters:
+            records = [r for r in records if r['DB%sIdentifier' % object_type] in f['Values'] or r['DB%sArn' % object_type] in f['Values']]
+        start = int(Marker or 0)
+        response = {'DB%ss' % object_type: copy.deepcopy(records[start:start + self.page_size])}
+        if start + self.page_size < len(records):
+            response['Marker'] = str(start + self.page_size)
+        return response
+
+    def describe_db_instances(self, **kwargs):
+        return self.describe('Instance', **kwargs)
+
+    def describe_db_clusters(self, **kwargs):
+        return self.describe('Cluster', **kwargs)
+
+    def set_status(self, object_type, identifier, status):
+        for record in self.records[object_type]:
+            if record['DB%sIdentifier' % object_type] == identifier:
+                record['DBInstanceStatus' if object_type == 'Instance' else 'Status'] = status
+
+    def start_db_instance(self, DBInstanceIdentifier):
+        self.set_status('Instance', DBInstanceIdentifier, 'available')
+
+    def stop_db_instance(self, DBInstanceIdentifier):
+        self.set_status('Instance', DBInstanceIdentifier, 'stopped')
+
+    def start_db_cluster(self, DBClusterIdentifier):
+        self.set_status('Cluster', DBClusterIdentifier, 'available')
+
+    def stop_db_cluster(self, DBClusterIdentifier):
+        self.set_status('Cluster', DBClusterIdentifier, 'stopped')
+
+    def add_tags_to_resource(self, ResourceName, Tags):
+        for record in self.records['Instance'] + self.records['Cluster']:
+            if ResourceName in (record.get('DBInstanceArn'), record.get('DBClusterArn')):
+                record['TagList'].extend(Tags)
+
+def rds_instance(identifier, status, **tags):
+    return {'DBInstanceIdentifier': identifier, 'DBInstanceArn': 'arn:aws:rds:us-east-1:123456789012:db:' + identifier,
+            'DBInstanceStatus': status, 'TagList': tag_list(**tags)}
+
+def rds_cluster(identifier, status, **tags):
+    return {'DBClusterIdentifier': identifier, 'DBClusterArn': 'arn:aws:rds:us-east-1:123456789012:cluster:' + identifier,
+            'Status': status, 'TagList': tag_list(**tags)}
+
+def test_timezone_tag_is_not_read_as_the_schedule_tag():
+    zoned = load_scheduler(TIMEZONE_TAG='schedule_tz')
+    # The time zone tag comes first, and its name contains the schedule tag name.
+    schedule = '{"daily": {"start": 9}}'
+    ec2 = FakeEC2Client([ec2_instance('i-1', 'stopped', schedule=schedule), ec2_instance('i-2', 'stopped', schedule_tz='Asia/Tokyo', schedule=schedule)])
+    rds = FakeRDS([rds_instance('db-1', 'stopped', schedule=schedule), rds_instance('db-2', 'stopped', schedule_tz='Asia/Tokyo', schedule=schedule)])
+    # wednesday 2024-01-10 00:00 UTC is 09:00 in Tokyo.
+    clock = zoned.get_clock(1704844800)
+    assert zoned.check(ec2, clock=clock)['started'] == ['i-2']
+    assert zoned.rds_check(rds, clock=clock)['started'] == ['db-2']
+    clock = zoned.get_clock(1704844800 + 9 * 3600)
+    assert zoned.check(ec2, clock=clock)['started'] == ['i-1']
+    assert zoned.rds_check(rds, clock=clock)['started'] == ['db-1']
+
+# Stands in for the Lambda context, with remaining_ms left until the invocation times out.
+class FakeContext(object):
+    function_name = 'aws-scheduler'
+
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+out_of_time = FakeContext(1000)
+monday_7 = scheduler.get_clock(1704697200)
+
+def test_continuation_stops_before_fetching_the_next_tag_page():
+    ec2 = FakeEC2Client([ec2_instance('i-%i' % i, 'stopped', schedule='{"mon": {"start": 7}}') for i in range(5)], page_size=2)
+    result = scheduler.check(ec2, context=out_of_time, clock=monday_7)
+    assert result['started'] == ['i-0', 'i-1']
+    assert result['cursor'] == {'token': '2'}
+    assert ec2.calls['describe_tags'] == ec2.calls['describe_instances'] == 1
+    # The continuation processes at least one page, however little time it has.
+    result = scheduler.check(ec2, context=out_of_time, cursor=result['cursor'], clock=monday_7)
+    assert result['started'] == ['i-2', 'i-3']
+    result = scheduler.check(ec2, context=FakeContext(600000), cursor=result['cursor'], clock=monday_7)
+    assert result['started'] == ['i-4'] and 'cursor' not in result
+
+def test_continuation_of_a_shard():
+    instance_ids = ['i-%i' % i for i in range(250)]
+    ec2 = FakeEC2Client([ec2_instance(i, 'running', schedule='{"mon": {"stop": 7}}') for i in instance_ids])
+    result = scheduler.check(ec2, instance_ids, context=out_of_time, clock=monday_7)
+    assert result['stopped'] == instance_ids[:200] and result['cursor'] == {'position': 200}
+    assert ec2.calls['describe_instances'] == 1
+    result = scheduler.check(ec2, instance_ids, context=out_of_time, cursor=result['cursor'], clock=monday_7)
+    assert result['stopped'] == instance_ids[200:] and 'cursor' not in result
+
+def test_rds_continuation_stops_before_fetching_the_next_page():
+    rds = FakeRDS([rds_instance('db-%i' % i, 'stopped', schedule='{"mon": {"start": 7}}') for i in range(2)],
+                  [rds_cluster('cluster-0', 'stopped', schedule='{"mon": {"start": 7}}')], page_size=1)
+    result = scheduler.rds_check(rds, context=out_of_time, clock=monday_7)
+    assert result['started'] == ['db-0'] and result['cursor'] == {'object_type': 'Instance', 'marker': '1'}
+    result = scheduler.rds_check(rds, context=out_of_time, cursor=result['cursor'], clock=monday_7)
+    assert result['started'] == ['db-1'] and result['cursor'] == {'object_type': 'Cluster', 'marker': None}
+    result = scheduler.rds_check(rds, context=out_of_time, cursor=result['cursor'], clock=monday_7)
+    assert result['started'] == ['cluster-0'] and 'cursor' not in result
+    assert rds.calls == {'describe_db_instances': 2, 'describe_db_clusters': 1}
+
+def test_shard_size_is_capped():
+    assert load_scheduler(SHARD_SIZE='100000').shard_size == 5000
+
+def test_coordinator_shards_the_fleet():
+    coordinating = load_scheduler(SHARD_SIZE='2')
+    ec2 = FakeEC2Client([ec2_instance('i-%i' % i, 'stopped', schedule='{"mon": {"start": 7}}') for i in range(5)], page_size=2)
+    rds = FakeRDS([rds_instance('db-0', 'stopped', schedule='{"mon": {"start": 7}}')])
+    coordinating.init = lambda region, role_arn=None: ec2
+    coordinating.rds_init = lambda region, role_arn=None: rds
+
+    class RecordingInvoker(coordinating.LocalInvoker):
+        def __init__(self):
+            coordinating.LocalInvoker.__init__(self)
+            self.events = []
+
+        def invoke(self, event):
+            self.events.append(event)
+            coordinating.LocalInvoker.invoke(self, event)
+
+    coordinating.shard_invoker = invoker = RecordingInvoker()
+    # The coordinator runs out of time after the first page, a continuation lists the rest.
+    summary = coordinating.handler({'run_time': monday_7.instant}, out_of_time)
+    assert summary == {'us-east-1': {'shards': 2, 'cursor': {'token': '2'}}}
+    assert [event['shard']['instance_ids'] for event in invoker.events if event.get('shard', {}).get('phase') == 'ec2'] == [['i-0', 'i-1'], ['i-2', 'i-3'], ['i-4']]
+    assert [event['coordinate'] for event in invoker.events if 'coordinate' in event] == [{'role_arn': None, 'region': 'us-east-1', 'cursor': {'token': '2'}}]
+    assert ec2.calls['describe_instances'] == 3 + 3
+    assert [instance['State']['Name'] for instance in ec2.instances.values()] == ['running'] * 5
+    assert rds.records['Instance'][0]['DBInstanceStatus'] == 'available'
+
+def test_clients_are_reused():
+    connected = load_scheduler()
+    ec2 = connected.get_connection('ec2', 'us-east-1')
+    assert connected.get_connection('ec2', 'us-east-1') is ec2
+    assert connected.get_connection('ec2', 'eu-west-1') is not ec2
+    assert connected.get_connection('rds', 'us-east-1') is not ec2
+
+# Stands in for the STS client. Assuming one of the blocked roles waits until the test releases it.
+class FakeSTS(object):
+    def __init__(self, expires_in=3600, blocked=()):
+        self.expires_in = expires_in
+        self.blocked = blocked
+        self.released = threading.Event()
+        self.assumed = []
+
+    def assume_role(self, RoleArn, RoleSessionName):
+        if RoleArn in self.blocked:
+            assert self.released.wait(5)
+        self.assumed.append(RoleArn)
+        expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.expires_in)
+        return {'Credentials': {'AccessKeyId': 'AKID', 'SecretAccessKey': 'secret', 'SessionToken': 'token', 'Expiration': expiration}}
+
+def with_sts(sts):
+    connected = load_scheduler()
+    connected.aws_connections[('sts', connected.aws_region, None)] = (None, sts)
+    return connected
+
+def test_role_sessions_are_reused_until_they_expire():
+    sts = FakeSTS()
+    connected = with_sts(sts)
+    ec2 = connected.get_connection('ec2', 'us-east-1', 'arn:a')
+    assert connected.get_connection('ec2', 'us-east-1', 'arn:a') is ec2
+    assert sts.assumed == ['arn:a']
+
+    # Credentials within role_renew_seconds of their expiry are renewed, and the clients rebuilt.
+    sts = FakeSTS(expires_in=60)
+    connected = with_sts(sts)
+    ec2 = connected.get_connection('ec2', 'us-east-1', 'arn:a')
+    assert connected.get_connection('ec2', 'us-east-1', 'arn:a') is not ec2
+    assert sts.assumed == ['arn:a', 'arn:a']
+
+def test_roles_are_assumed_side_by_side():
+    sts = FakeSTS(blocked=['arn:slow'])
+    connected = with_sts(sts)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        slow = executor.submit(connected.get_session, 'arn:slow')
+        # Another account's role does not wait for the slow one.
+        executor.submit(connected.get_session, 'arn:fast').result(timeout=5)
+        assert sts.assumed == ['arn:fast']
+        sts.released.set()
+        slow.result(timeout=5)
+    assert sts.assumed == ['arn:fast', 'arn:slow']
+
+def test_check_starts_and_stops_due_instances(monkeypatch):
+    monkeypatch.setenv('EXCLUDE', 'i-excluded')
+    forced = load_scheduler(SCHEDULE_TAG_FORCE='true')
+    to_stop = ['i-stop-%03i' % i for i in range(150)]
+    ec2 = FakeEC2Client([ec2_instance(i, 'running', schedule='{"workday": {"stop": 7}}') for i in to_stop] + [
+        ec2_instance('i-start', 'stopped', schedule='mon_start=7 mon_stop=19'),
+        ec2_instance('i-started', 'running', schedule='mon_start=7 mon_stop=19'),
+        ec2_instance('i-later', 'running', schedule='{"mon": {"stop": 19}}'),
+        ec2_instance('i-terminated', 'terminated', schedule='{"mon": {"start": 7}}'),
+        ec2_instance('i-untagged', 'running'),
+        ec2_instance('i-asg', 'running', **{'aws:autoscaling:groupName': 'asg'}),
+        ec2_instance('i-excluded', 'running'),
+    ])
+    result = forced.check(ec2, clock=monday_7)
+    assert result['started'] == ['i-start']
+    assert result['stopped'] == to_stop
+    assert result['failed'] == []
+    assert ec2.calls['start_instances'] == 1 and ec2.calls['stop_instances'] == 2
+    assert ec2.instances['i-later']['State']['Name'] == 'running'
+    # Untagged instances get the default schedule, unless they are excluded or part of an auto scaling group.
+    assert ec2.instances['i-untagged']['Tags'] == [{'Key': 'schedule', 'Value': forced.ec2_default_schedule}]
+    assert [tag['Key'] for tag in ec2.instances['i-asg']['Tags']] == ['aws:autoscaling:groupName']
+    assert ec2.instances['i-excluded']['Tags'] == []
+
+def test_rds_check_starts_and_stops_due_databases(monkeypatch):
+    monkeypatch.setenv('EXCLUDE', 'db-excluded')
+    forced = load_scheduler(SCHEDULE_TAG_FORCE='true')
+    rds = FakeRDS([
+        rds_instance('db-start', 'stopped', schedule='mon_start=7 mon_stop=19'),
+        rds_instance('db-stop', 'available', schedule='{"daily": {"stop": 7}}'),
+        rds_instance('db-stopping', 'stopping', schedule='{"daily": {"stop": 7}}'),
+        rds_instance('db-later', 'available', schedule='{"mon": {"stop": 19}}'),
+        rds_instance('db-untagged', 'available'),
+        rds_instance('db-excluded', 'available'),
+    ], [
+        rds_cluster('cluster-stop', 'available', schedule='daily_stop=7'),
+        rds_cluster('cluster-start', 'stopped', schedule='{"workday": {"start": 7}}'),
+    ], page_size=2)
+    result = forced.rds_check(rds, clock=monday_7)
+    assert sorted(result['started']) == ['cluster-start', 'db-start']
+    assert sorted(result['stopped']) == ['cluster-stop', 'db-stop']
+    assert result['failed'] == [] and 'cursor' not in result
+    # Every page is read, and the tags come with the describe response.
+    assert rds.calls == {'describe_db_instances': 3, 'describe_db_clusters': 1}
+    assert rds.records['Instance'][4]['TagList'] == [{'Key': 'schedule', 'Value': 'mon_start=7 mon_stop=20 tue_start=7 tue_stop=20 wed_start=7 wed_stop=20 thu_start=7 thu_stop=20 fri_start=7 fri_stop=20'}]
+    assert rds.records['Instance'][5]['TagList'] == []
+
+# Stands in for the Resource Groups Tagging API client, returning page_size resources per page.
+class FakeTagging(object):
+    def __init__(self, resources, page_size=100):
+        self.resources = resources
+        self.page_size = page_size
+        self.calls = 0
+
+    def get_resources(self, TagFilters, ResourceTypeFilters, PaginationToken=''):
+        self.calls += 1
+        keys = [f['Key'] for f in TagFilters]
+        # arn:aws:ec2:region:account:instance/i-1 is an 'ec2:instance', arn:aws:rds:region:account:db:db-1 an 'rds:db'.
+        mappings = [{'ResourceARN': arn, 'Tags': tags} for arn, tags in self.resources
+                    if arn.split(':')[2] + ':' + arn.split(':')[5].split('/')[0] in ResourceTypeFilters and any(tag['Key'] in keys for tag in tags)]
+        start = int(PaginationToken or 0)
+        end = start + self.page_size
+        return {'ResourceTagMappingList': mappings[start:end], 'PaginationToken': str(end) if end < len(mappings) else ''}
+
+def tagged(records):
+    resources = []
+    for record in records:
+        if 'InstanceId' in record:
+            resources.append(('arn:aws:ec2:us-east-1:123456789012:instance/' + record['InstanceId'], record['Tags']))
+        else:
+            resources.append((record.get('DBInstanceArn') or record['DBClusterArn'], record['TagList']))
+    return resources
+
+def test_tagging_discovery_describes_only_due_resources():
+    discovering = load_scheduler(DISCOVERY='tagging')
+    instances = [ec2_instance('i-%i' % i, 'stopped', schedule='{"mon": {"start": 7}}' if i % 2 else '{"mon": {"start": 9}}') for i in range(6)]
+    ec2 = FakeEC2Client(instances + [ec2_instance('i-untagged', 'stopped')])
+    databases = [rds_instance('db-0', 'stopped', schedule='{"mon": {"start": 7}}'), rds_instance('db-1', 'stopped', schedule='{"mon": {"start": 9}}')]
+    clusters = [rds_cluster('cluster-0', 'stopped', schedule='{"mon": {"start": 9}}')]
+    rds = FakeRDS(databases, clusters)
+    tagging = FakeTagging(tagged(instances + databases + clusters), page_size=4)
+
+    result = discovering.check(ec2, clock=monday_7, tagging=tagging)
+    assert result['started'] == ['i-1', 'i-3', 'i-5']
+    assert ec2.described == ['i-1', 'i-3', 'i-5']
+    assert tagging.calls == 2
+    result = discovering.rds_check(rds, clock=monday_7, tagging=tagging)
+    assert result['started'] == ['db-0']
+    assert rds.calls == {'describe_db_instances': 1}
+
+def test_tag_pass_describes_only_due_instances():
+    due = [ec2_instance('i-due-%03i' % i, 'stopped', schedule='{"mon": {"start": 7}}') for i in range(300)]
+    # Both tag keys contain the schedule tag name, the instance is still described once.
+    due.append(ec2_instance('i-two-tags', 'stopped', schedule='{"mon": {"start": 7}}', schedule_old='{"mon": {"start": 7}}'))
+    idle = [ec2_instance('i-idle-%03i' % i, 'stopped', schedule='{"mon": {"start": 9}}') for i in range(100)]
+    ec2 = FakeEC2Client(due + idle + [ec2_instance('i-untagged', 'stopped')])
+    result = scheduler.check(ec2, clock=monday_7)
+    due_ids = [instance['InstanceId'] for instance in due]
+    assert result['started'] == due_ids
+    assert ec2.described == due_ids
+    assert ec2.calls['describe_tags'] == 1 and ec2.calls['describe_instances'] == 2
+
+def test_resources_are_bucketed_by_time_zone():
+    zoned = load_scheduler(TIMEZONE_TAG='tz')
+    # wednesday 2024-01-10 00:00 UTC is tuesday 19:00 in New York and wednesday 09:00 in Tokyo.
+    clock = zoned.get_clock(1704844800)
+    week_hour = zoned.week_hour
+    assert zoned.resource_week_hour([], clock) == week_hour('wed', 0)
+    assert zoned.resource_week_hour(tag_list(tz='America/New_York'), clock) == week_hour('tue', 19)
+    assert zoned.resource_week_hour(tag_list(tz='Asia/Tokyo'), clock) == week_hour('wed', 9)
+    assert zoned.resource_week_hour(tag_list(tz='Nowhere/Zone'), clock) == week_hour('wed', 0)
+
+    schedule = '{"daily": {"start": 9, "stop": 19}}'
+    ec2 = FakeEC2Client([ec2_instance('i-%i' % i, 'running' if i % 2 else 'stopped', tz=['Asia/Tokyo', 'America/New_York'][i % 2], schedule=schedule) for i in range(100)])
+    result = zoned.check(ec2, clock=clock)
+    assert result['started'] == ['i-%i' % i for i in range(0, 100, 2)]
+    assert result['stopped'] == ['i-%i' % i for i in range(1, 100, 2)]
+    # Each zone is converted once per run.
+    assert sorted(zoned.zone_week_hours['hours']) == ['America/New_York', 'Asia/Tokyo', 'Nowhere/Zone']
@@ -47,6 +47,63 @@ variable "rds_schedule" {
   description = "Whether to do scheduling for RDS instances."
 }
 
+variable "rds_workers" {
+  type        = string
+  default     = "10"
+  description = "Number of threads used to start, stop and tag RDS instances and clusters in parallel."
+}
+
+variable "regions" {
+  default     = ""
+  description = "comma separated list of regions to schedule EC2 and RDS instances in. Default is the region the lambda runs in."
+}
+
+variable "role_arns" {
+  default     = ""
+  description = "comma separated list of IAM role arns to assume, one per account to schedule. Default is the account the lambda runs in."
+}
+
+variable "account_workers" {
+  type        = string
+  default     = "5"
+  description = "Number of accounts from role_arns scheduled in parallel."
+}
+
+variable "shard_size" {
+  type        = string
+  default     = "0"
+  description = "Number of EC2 instances per worker invocation. When set the scheduled invocation splits the fleet into shards and invokes the lambda once per shard. 0 disables sharding, at most 5000."
+}
+
+variable "discovery" {
+  default     = "describe"
+  description = "How EC2 and RDS instances are found. 'describe' lists all instances, 'tagging' uses the Resource Groups Tagging API to find instances with the schedule tag and only describes those with an action due."
+}
+
+variable "early_exit" {
+  type        = string
+  default     = "false"
+  description = "Whether to skip a run when no schedule tag seen by the last complete run has a start or stop at the current hour."
+}
+
+variable "reconcile" {
+  type        = string
+  default     = "false"
+  description = "Whether each run brings resources to the state of the most recent start or stop of their schedule tag, rather than acting only at the hour of a start or stop."
+}
+
+variable "adaptive_wakeup" {
+  type        = string
+  default     = "false"
+  description = "Whether each run sets the schedule expression of the event rule to the next hour at which a schedule has a start or stop."
+}
+
+variable "timezone_tag" {
+  type        = string
+  default     = ""
+  description = "Name of a tag that gives the time zone of a resource's schedule, instead of time. Empty to disable."
+}
+
 variable "security_group_ids" {
   type        = list(string)
   default     = []